@@ -0,0 +1,175 @@
+#!/usr/bin/python
+
+"""Measure capture throughput with a simulated camera.
+
+Runs the same camera, writer and encoder code as a real capture, fed by a
+synthetic.Backend instead of the Grasshopper3, and reports how many frames
+per second reach the disk. No camera, turntable or display is needed.
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+import numpy
+
+import camera
+import codec
+import container
+import encoder
+import manifest
+import rect
+import synthetic
+import writer
+
+# degrees per second the simulated turntable turns at
+turntable_speed = 10.0
+
+
+def run(backend, location, duration, codec_name='raw', raw=False,
+        selection=None, sensor_roi=False, encoders=0, use_container=False,
+        workers=writer.default_workers, queue_size=writer.default_queue_size):
+    """Capture from backend into location for duration seconds.
+
+    Return a dict of statistics.
+    """
+    cam = camera.Camera(backend)
+    cam.connect()
+
+    info = cam.fmt7info
+    if selection is None:
+        selection = rect.Rect(0, 0, info.maxWidth, info.maxHeight)
+    elif raw:
+        # whole 2x2 Bayer tiles, as main.py does
+        selection = rect.Rect(selection.left - selection.left % 2,
+                              selection.top - selection.top % 2,
+                              selection.width - selection.width % 2,
+                              selection.height - selection.height % 2)
+
+    readout = cam.capture(raw, selection if sensor_roi else None)
+    crop = rect.Rect(selection.left - readout.left,
+                     selection.top - readout.top,
+                     selection.width, selection.height)
+    order = cam.order
+    shape = (crop.height, crop.width) if raw else \
+        (crop.height, crop.width, 3)
+
+    frames = manifest.Manifest(os.path.join(location, manifest.name),
+                               selection, *cam.exposure(), order)
+    chosen = codec.codecs()[codec_name]
+
+    if encoders > 0:
+        output = encoder.Encoder(location, shape, chosen, encoders,
+                                 manifest=frames, order=order)
+    elif use_container:
+        output = writer.Writer(container.Container(
+                                   os.path.join(location, 'capture.seal'),
+                                   int(numpy.prod(shape)),
+                                   int(duration * backend.frame_rate) + 1,
+                                   order),
+                               workers, queue_size, frames)
+    else:
+        output = writer.Writer(writer.Files(location, chosen, order),
+                               workers, queue_size, frames)
+
+    start_time = time.monotonic()
+
+    def task(frame):
+        elapsed = frame.host_time - start_time
+        roi = frame.array[crop.top:crop.top + crop.height,
+                          crop.left:crop.left + crop.width]
+        output.put(roi, elapsed, elapsed * turntable_speed, frame)
+
+    start_count = cam.pool.count
+    start_dropped = cam.camera.dropped
+    cam.callback = task
+    time.sleep(duration)
+
+    # joins the delivery thread, so no callback is still putting a frame
+    # when the output closes
+    cam.camera.stopCapture()
+    cam.callback = None
+    delivered = cam.pool.count - start_count
+    backend_dropped = cam.camera.dropped - start_dropped
+
+    output.close()
+    elapsed = time.monotonic() - start_time
+    cam.release()
+
+    saved = len(manifest.load(os.path.join(location, manifest.name)))
+
+    return {'delivered': delivered,
+            'saved': saved,
+            'camera_dropped': backend_dropped,
+            'pool_dropped': cam.pool.dropped,
+            'stalls': output.stalls,
+            'stall_time': output.stall_time,
+            'max_depth': output.max_depth,
+            'fps': saved / elapsed,
+            'mb_per_second': saved * numpy.prod(shape) / elapsed / 1e6}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark capture with '
+                                                 'a simulated camera.')
+    parser.add_argument('--width', type=int, default=synthetic.default_width)
+    parser.add_argument('--height', type=int,
+                        default=synthetic.default_height)
+    parser.add_argument('--rate', type=float,
+                        default=synthetic.default_frame_rate,
+                        help='camera frames per second (default: %d)' %
+                             synthetic.default_frame_rate)
+    parser.add_argument('--formats', default=','.join(synthetic.
+                                                      default_formats),
+                        help='pixel formats the camera supports, drop BGR '
+                             'to test the RGB path')
+    parser.add_argument('--replay',
+                        help='directory of images to play back')
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='seconds to capture for (default: 5)')
+    parser.add_argument('--codec', choices=sorted(codec.codecs()),
+                        default='raw')
+    parser.add_argument('--raw', action='store_true',
+                        help='capture RAW8 Bayer frames')
+    parser.add_argument('--roi', type=int, nargs=4,
+                        metavar=('LEFT', 'TOP', 'WIDTH', 'HEIGHT'),
+                        help='region of interest to save')
+    parser.add_argument('--sensor-roi', action='store_true',
+                        help='read only the region out of the sensor')
+    parser.add_argument('--encoders', type=int, default=0,
+                        help='encoder processes, 0 saves on threads')
+    parser.add_argument('--container', action='store_true',
+                        help='save into a capture.seal container')
+    parser.add_argument('--output',
+                        help='directory to capture into (default: a '
+                             'temporary directory, deleted afterwards)')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    backend = synthetic.Backend(args.width, args.height, args.rate,
+                                tuple(args.formats.split(',')), args.replay)
+    selection = rect.Rect(*args.roi) if args.roi else None
+
+    with tempfile.TemporaryDirectory() as location:
+        if args.output:
+            location = args.output
+            os.makedirs(location, exist_ok=True)
+
+        stats = run(backend, location, args.duration, args.codec, args.raw,
+                    selection, args.sensor_roi, args.encoders,
+                    args.container)
+
+    print("%(saved)d of %(delivered)d frames saved, %(fps).1f fps, "
+          "%(mb_per_second).1f MB/s" % stats)
+    print("camera dropped %(camera_dropped)d, pool dropped %(pool_dropped)d, "
+          "%(stalls)d stalls (%(stall_time).2fs), "
+          "queue depth peaked at %(max_depth)d" % stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+class AngleBinner:
+    """Keep only the frame closest to each multiple of an angular step.
+
+    Frames are offered in capture order with add(). The best candidate for
+    the current bin is held back until a frame for a later bin arrives, then
+    handed to keep(). Every frame that loses is handed to drop() straight
+    away, so it never reaches the encoder.
+    """
+
+    def __init__(self, step, keep, drop):
+        """Startup.
+
+        step -- bin width in degrees, bins are centred on multiples of it
+        keep -- called with the item chosen for each bin
+        drop -- called with every other item
+        """
+        self.step = step
+        self.keep = keep
+        self.drop = drop
+
+        self.bin = None
+        self.distance = None
+        self.item = None
+
+        self.kept = 0
+        self.dropped = 0
+
+    def add(self, position, item):
+        """Offer an item taken at position degrees."""
+        bin = round(position / self.step)
+        distance = abs(position - bin * self.step)
+
+        if bin == self.bin:
+            if distance >= self.distance:
+                self.dropped += 1
+                self.drop(item)
+                return
+
+            self.dropped += 1
+            self.drop(self.item)
+        else:
+            self.flush()
+
+        self.bin = bin
+        self.distance = distance
+        self.item = item
+
+    def flush(self):
+        """Keep the candidate for the current bin, if any."""
+        if self.item is not None:
+            self.kept += 1
+            self.keep(self.item)
+
+        self.bin = None
+        self.distance = None
+        self.item = None
@@ -1,15 +1,47 @@
 from enum import Enum
 
 import logging
+import math
+import threading
 import time
 
 import cv2
-import PyCapture2
+import numpy
+
+import rect
+
+# optional, camera.Camera can be given synthetic.Backend() instead
+try:
+    import PyCapture2
+except ImportError:
+    PyCapture2 = None
 
 
 # # supported cameras
 # supported_cameras = [b'Grasshopper3 GS3-U3-120S6C']
 
+# frames kept for the camera to fill, this needs to cover the frames queued
+# for saving during capture plus the latest frame and the one in the preview
+frame_pool_size = 24
+
+# colour pixel formats to try, best first: cv2 works in BGR, so BGR frames
+# can be saved and scored without converting them. These are also the
+# channel orders of the frames they give, see Frame.order
+colour_formats = ('BGR', 'RGB')
+
+# cv2 conversions to gray for each channel order
+gray_codes = {'BGR': cv2.COLOR_BGR2GRAY,
+              'RGB': cv2.COLOR_RGB2GRAY}
+
+
+def snap_down(value, step):
+    return value - value % step
+
+
+def snap_up(value, step):
+    return -(-value // step) * step
+
+
 # track the detailed part of the last error generated by a subsystem here
 # we present it with a summary during error messages
 last_detail = ""
@@ -37,24 +69,133 @@ class Error(Exception):
         return '%s - %s' % (self.message, self.detail)
 
 
+class Frame:
+    """A frame from the camera, held in a buffer owned by a FramePool.
+
+    Frames are reference counted: take a reference with acquire() before
+    keeping a frame beyond the call that gave it to you, and drop it with
+    release(). The buffer is refilled once nobody holds the frame.
+
+    order is 'BGR' or 'RGB' for colour frames and None for single channel
+    (RAW8 Bayer) ones.
+    """
+
+    __slots__ = ('pool', 'refs', 'array', 'order', 'index', 'host_time',
+                 'cols', 'rows', 'stride', 'seconds', 'microSeconds')
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.refs = 0
+        self.array = None
+        self.order = None
+        self.index = -1
+        self.host_time = 0.0
+
+        self.cols = 0
+        self.rows = 0
+        self.stride = 0
+        self.seconds = 0
+        self.microSeconds = 0
+
+    def acquire(self):
+        self.pool.acquire(self)
+        return self
+
+    def release(self):
+        self.pool.release(self)
+
+
+class FramePool:
+    """A fixed set of preallocated frames.
+
+    Buffers are only allocated the first time a frame is used at a given
+    size, so steady-state capture does no large allocations. When every frame
+    is held get() returns None and the camera drops the new frame.
+    """
+
+    def __init__(self, size=frame_pool_size):
+        self.lock = threading.Lock()
+        self.free = [Frame(self) for i in range(size)]
+        self.count = 0
+        self.dropped = 0
+
+    def get(self, shape, dtype):
+        """Take a free frame with an array of shape and dtype, or None."""
+        with self.lock:
+            if not self.free:
+                self.dropped += 1
+                return None
+
+            frame = self.free.pop()
+            frame.refs = 1
+            self.count += 1
+
+        if frame.array is None or \
+                frame.array.shape != shape or frame.array.dtype != dtype:
+            logging.debug('camera: allocating frame buffer %s', shape)
+            frame.array = numpy.empty(shape, dtype)
+
+        return frame
+
+    def acquire(self, frame):
+        with self.lock:
+            frame.refs += 1
+
+    def release(self, frame):
+        with self.lock:
+            frame.refs -= 1
+            if frame.refs == 0:
+                self.free.append(frame)
+
+
 class Camera:
     """Talk to a USB camera with PyCapture2."""
 
-    def __init__(self):
-        """Initialise the PyCapture2 Camera."""
-        self.busManager = PyCapture2.BusManager()
-        self.camera = PyCapture2.Camera()
+    def __init__(self, backend=None):
+        """Initialise the PyCapture2 Camera.
 
-        # Temporary buffer
+        backend -- the PyCapture2 module, or anything with the same
+            interface, such as a synthetic.Backend
+        """
+        if backend is None:
+            if PyCapture2 is None:
+                raise Error('PyCapture2 is not installed',
+                            'run with --synthetic for a simulated camera')
+            backend = PyCapture2
+
+        self.backend = backend
+        self.busManager = backend.BusManager()
+        self.camera = backend.Camera()
+
+        # the channel order of frames in each colour pixel format
+        self.channel_orders = {getattr(backend.PIXEL_FORMAT, name): name
+                               for name in colour_formats}
+
+        # the most recent frame, and the pool it was taken from
+        self.pool = FramePool()
+        self.lock = threading.Lock()
         self.buffer = None
         self.callback = None
 
+        # frames the camera has delivered, numbers each frame so frames the
+        # pool had to drop leave a gap in the index
+        self.arrived = 0
+
         # Declare camera modes here
         self.mode_current = None
 
+        # channel order of the current mode, and the colour pixel format
+        # chosen on connect
+        self.order = None
+        self.colour_format = None
+
         self.mode_default = None
         self.mode_focus = None
         self.mode_capture = None
+        self.mode_raw = None
+
+        # sensor size and Format7 unit sizes, set on connect
+        self.fmt7info = None
 
         # image = cv2.imread('demo-1.jpg', cv2.IMREAD_COLOR)
         # image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
@@ -75,6 +216,7 @@ class Camera:
         """
         if not self.camera.isConnected:
             logging.debug('** camera init')
+            backend = self.backend
             numCams = self.busManager.getNumOfCameras()
 
             if numCams == 0:
@@ -85,26 +227,50 @@ class Camera:
                 uid = self.busManager.getCameraFromIndex(0)
                 self.camera.connect(uid)
                 self.camera.startCapture()
-            except PyCapture2.Fc2error:
+            except backend.Fc2error:
                 raise Error('Unable to connect to camera')
 
             # check if PREVIEW is supported
-            fmt7info, supported = self.camera.getFormat7Info(PyCapture2.
-                                                             MODE.MODE_0)
+            fmt7info, supported = self.camera.getFormat7Info(backend.MODE.
+                                                             MODE_0)
+            self.fmt7info = fmt7info
+
+            for name in colour_formats:
+                pixel_format = getattr(backend.PIXEL_FORMAT, name)
+                fmt7imgSet = backend.Format7ImageSettings(backend.MODE.MODE_0,
+                                                          0, 0,
+                                                          fmt7info.maxWidth,
+                                                          fmt7info.maxHeight,
+                                                          pixel_format)
+
+                # cameras without the format may refuse it outright rather
+                # than report it invalid
+                try:
+                    fmt7pktInf, isValid = self.camera.validateFormat7Settings(fmt7imgSet)
+                except backend.Fc2error:
+                    continue
+
+                if isValid:
+                    break
+            else:
+                raise Error('Camera does not support Preview mode')
 
-            fmt7imgSet = PyCapture2.Format7ImageSettings(PyCapture2.MODE.
-                                                         MODE_0, 0, 0,
-                                                         fmt7info.maxWidth,
-                                                         fmt7info.maxHeight,
-                                                         PyCapture2.
-                                                         PIXEL_FORMAT.RGB)
+            logging.debug('camera: %s frames', name)
+            self.colour_format = pixel_format
+            self.mode_preview = (fmt7pktInf.recommendedBytesPerPacket, fmt7imgSet)
 
-            fmt7pktInf, isValid = self.camera.validateFormat7Settings(fmt7imgSet)
+            # the sensor's own Bayer data, a third of the bytes of RGB
+            fmt7imgSet = backend.Format7ImageSettings(backend.MODE.MODE_0,
+                                                      0, 0,
+                                                      fmt7info.maxWidth,
+                                                      fmt7info.maxHeight,
+                                                      backend.PIXEL_FORMAT.
+                                                      RAW8)
 
-            if not isValid:
-                raise Error('Camera does not support Preview mode')
+            fmt7pktInf, isValid = self.camera.validateFormat7Settings(fmt7imgSet)
 
-            self.mode_preview = (fmt7pktInf.recommendedBytesPerPacket, fmt7imgSet)
+            if isValid:
+                self.mode_raw = (fmt7pktInf.recommendedBytesPerPacket, fmt7imgSet)
 
             logging.debug('** camera connected')
             self.ensure_mode(self.mode_preview)
@@ -120,36 +286,158 @@ class Camera:
             self.camera.disconnect()
 
     def capture_cb(self, image):
-        if self.callback:
-            self.callback(image)
+        # time.monotonic() on arrival, comparable with stage position history
+        host_time = time.monotonic()
+
+        image_data = image.__array__()
+
+        index = self.arrived
+        self.arrived += 1
+
+        frame = self.pool.get(image_data.shape, image_data.dtype)
+        if frame is None:
+            return
+
+        numpy.copyto(frame.array, image_data)
 
         timestamp = image.getTimeStamp()
 
-        self.buffer = {'cols': image.getCols(),
-                       'array': image.__array__(),
-                       'rows': image.getRows(),
-                       'stride': image.getStride(),
-                       'seconds': timestamp.seconds,
-                       'microSeconds': timestamp.microSeconds}
+        frame.order = self.order
+        frame.index = index
+        frame.host_time = host_time
+        frame.cols = image.getCols()
+        frame.rows = image.getRows()
+        frame.stride = image.getStride()
+        frame.seconds = timestamp.seconds
+        frame.microSeconds = timestamp.microSeconds
+
+        if self.callback:
+            self.callback(frame)
+
+        with self.lock:
+            previous = self.buffer
+            self.buffer = frame
 
+        if previous is not None:
+            previous.release()
+
+    def latest(self):
+        """Return the most recent frame with a reference held, or None.
+
+        Call release() on the frame once you are done with it.
+        """
+        with self.lock:
+            if self.buffer is None:
+                return None
+
+            return self.buffer.acquire()
 
     def ensure_mode(self, mode):
         if self.mode_current != mode:
             self.camera.stopCapture()
-            self.buffer = None
+
+            with self.lock:
+                previous = self.buffer
+                self.buffer = None
+
+            if previous is not None:
+                previous.release()
+
             self.camera.setFormat7ConfigurationPacket(*mode)
             self.mode_current = mode
+            self.order = self.channel_orders.get(mode[1].pixelFormat)
             self.camera.startCapture(self.capture_cb)
 
             while self.buffer is None:
                 time.sleep(0.05)
 
+    def exposure(self):
+        """Return the current (shutter, gain), in ms and dB."""
+        self.connect()
+
+        shutter = self.camera.getProperty(self.backend.PROPERTY_TYPE.SHUTTER)
+        gain = self.camera.getProperty(self.backend.PROPERTY_TYPE.GAIN)
+
+        return shutter.absValue, gain.absValue
+
+    def frame_rate(self, duration=0.5):
+        """Measure the frames per second the camera is delivering."""
+        start_count = self.pool.count
+        start_time = time.time()
+
+        time.sleep(duration)
+
+        return (self.pool.count - start_count) / (time.time() - start_time)
+
+    def capture(self, raw=False, selection=None):
+        """Switch the camera to its capture mode.
+
+        raw -- deliver undemosaiced RAW8 Bayer frames, see demosaic.py
+        selection -- a rect.Rect of the sensor to read out, None for all of
+            it. Reading out less lets the camera run at a higher frame rate.
+        The selection is grown to the camera's Format7 unit sizes, the
+        rect.Rect actually read out is returned and frames then cover just
+        that area.
+        Frames then come in self.order, see Frame.order.
+        The preview mode is restored by the next call to preview().
+        """
+        logging.debug('** camera capture')
+
+        self.connect()
+
+        if raw and self.mode_raw is None:
+            raise Error('Camera does not support RAW8 capture')
+
+        info = self.fmt7info
+
+        if selection is None:
+            self.ensure_mode(self.mode_raw if raw else self.mode_preview)
+            return rect.Rect(0, 0, info.maxWidth, info.maxHeight)
+
+        # Bayer readouts must start on a whole 2x2 tile
+        tile = 2 if raw else 1
+        offset_h = math.lcm(max(info.offsetHStepSize, 1), tile)
+        offset_v = math.lcm(max(info.offsetVStepSize, 1), tile)
+        step_h = max(info.imageHStepSize, 1)
+        step_v = max(info.imageVStepSize, 1)
+
+        left = snap_down(selection.left, offset_h)
+        top = snap_down(selection.top, offset_v)
+        width = snap_up(selection.right() - left, step_h)
+        height = snap_up(selection.bottom() - top, step_v)
+
+        # growing may have pushed us off the far edge
+        if left + width > info.maxWidth:
+            left = max(0, snap_down(info.maxWidth - width, offset_h))
+            width = min(width, info.maxWidth - left)
+        if top + height > info.maxHeight:
+            top = max(0, snap_down(info.maxHeight - height, offset_v))
+            height = min(height, info.maxHeight - top)
+
+        backend = self.backend
+        pixel_format = backend.PIXEL_FORMAT.RAW8 if raw else \
+            self.colour_format
+        fmt7imgSet = backend.Format7ImageSettings(backend.MODE.MODE_0,
+                                                  left, top,
+                                                  width, height,
+                                                  pixel_format)
+
+        fmt7pktInf, isValid = self.camera.validateFormat7Settings(fmt7imgSet)
+
+        if not isValid:
+            raise Error('Camera does not support this region of interest',
+                        str(selection))
+
+        self.mode_capture = (fmt7pktInf.recommendedBytesPerPacket, fmt7imgSet)
+        self.ensure_mode(self.mode_capture)
+
+        return rect.Rect(left, top, width, height)
+
     def preview(self):
         """Connect and capture a preview frame.
 
-        Return the preview as a(data, length) tuple pointing to a memory
-        area containing a jpeg-compressed image. The data poiner is only valid
-        until the next call to preview().
+        Return the most recent Frame, with a reference held for you. Call
+        release() on it once you are done with the pixels.
         Preview can fail for short periods. If you get None back, try again
         later.
         """
@@ -158,4 +446,4 @@ class Camera:
         self.connect()
         self.ensure_mode(self.mode_preview)
 
-        return self.buffer
+        return self.latest()
@@ -0,0 +1,209 @@
+"""Lossless formats for captured frames.
+
+Each codec turns a region of interest into the bytes of a file. benchmark()
+times every codec on a sample frame, and choose() picks the one with the
+highest end to end frame rate once the speed of the disk is taken into
+account -- on a slow external drive a compressed format can beat writing raw
+pixels.
+"""
+
+import io
+import logging
+import os
+import time
+
+import cv2
+import numpy
+
+# zlib level for PNG, 1 is fastest, 9 smallest
+default_png_level = 3
+
+# bytes written when timing the disk
+disk_sample_size = 64 * 1024 * 1024
+
+
+class Codec:
+    """A way of storing a frame.
+
+    name -- how the user picks this codec
+    extension -- the file extension, including the dot
+    """
+
+    name = None
+    extension = None
+
+    def encode(self, roi, order='RGB'):
+        """Return the file contents for roi.
+
+        order -- the channel order of a colour roi, see camera.Frame.order
+        """
+        raise NotImplementedError
+
+    def save(self, path, roi, order='RGB'):
+        with open(path, 'wb') as f:
+            f.write(self.encode(roi, order))
+
+    def load(self, path, shape=None):
+        """Read a frame back from a file written by save().
+
+        shape -- the frame's shape, for formats that don't record it
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '<Codec %s>' % self.name
+
+
+class Raw(Codec):
+    """Pixels exactly as the camera delivered them, with no header."""
+
+    name = 'raw'
+    extension = '.raw'
+
+    def encode(self, roi, order='RGB'):
+        return numpy.ascontiguousarray(roi).data.cast('B')
+
+    def load(self, path, shape=None):
+        if shape is None:
+            raise ValueError('%s has no header, its shape is needed' % path)
+
+        return numpy.fromfile(path, numpy.uint8).reshape(shape)
+
+
+class Npy(Codec):
+    """A numpy .npy file, raw pixels plus the shape and type."""
+
+    name = 'npy'
+    extension = '.npy'
+
+    def encode(self, roi, order='RGB'):
+        f = io.BytesIO()
+        numpy.save(f, roi)
+        return f.getbuffer()
+
+    def load(self, path, shape=None):
+        return numpy.load(path)
+
+
+class Image(Codec):
+    """A format cv2.imencode understands, stored in BGR order."""
+
+    def __init__(self, name, extension, params=()):
+        self.name = name
+        self.extension = extension
+        self.params = list(params)
+
+    def encode(self, roi, order='RGB'):
+        # BGR frames go straight through, saving a full frame copy
+        if roi.ndim == 3 and order == 'RGB':
+            roi = cv2.cvtColor(roi, cv2.COLOR_RGB2BGR)
+
+        ok, data = cv2.imencode(self.extension, roi, self.params)
+        if not ok:
+            raise ValueError('unable to encode %s' % self.name)
+
+        return data.data
+
+    def load(self, path, shape=None):
+        """Colour frames come back in BGR order."""
+        image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise ValueError('unable to read %s' % path)
+
+        return image
+
+
+def Tiff(name, compression):
+    return Image(name, '.tiff', [cv2.IMWRITE_TIFF_COMPRESSION, compression])
+
+
+def Png(level=default_png_level):
+    return Image('png', '.png', [cv2.IMWRITE_PNG_COMPRESSION, level])
+
+
+def codecs(png_level=default_png_level):
+    """Return every codec, by name."""
+    return {c.name: c for c in (Raw(),
+                                Npy(),
+                                Tiff('tiff', 1),
+                                Tiff('tiff-lzw', 5),
+                                Tiff('tiff-deflate', 8),
+                                Png(png_level))}
+
+
+def disk_speed(location, size=disk_sample_size):
+    """Measure how fast location can take data, in bytes per second."""
+    path = os.path.join(location, '.disk_speed')
+    data = os.urandom(size)
+
+    start_time = time.time()
+    with open(path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    elapsed = time.time() - start_time
+
+    os.remove(path)
+
+    return size / max(elapsed, 1e-6)
+
+
+class Result:
+    """How a codec did in benchmark()."""
+
+    def __init__(self, codec, encode_time, size, sample_size):
+        self.codec = codec
+        self.encode_time = encode_time
+        self.size = size
+        self.ratio = sample_size / size
+        self.speed = sample_size / max(encode_time, 1e-9) / 1e6
+
+    def frame_rate(self, workers, disk):
+        """Frames per second with workers encoding and disk bytes/s."""
+        return min(workers / max(self.encode_time, 1e-9), disk / self.size)
+
+    def __str__(self):
+        return '%s: %.1f MB/s, ratio %.2f' % (self.codec.name,
+                                              self.speed, self.ratio)
+
+
+def benchmark(sample, candidates=None, repeat=3, order='RGB'):
+    """Time each codec encoding sample, return a list of Result.
+
+    The best of repeat runs is used. order is the sample's channel order.
+    """
+    if candidates is None:
+        candidates = codecs().values()
+
+    results = []
+    for codec in candidates:
+        best = None
+        for i in range(repeat):
+            start_time = time.time()
+            size = len(codec.encode(sample, order))
+            elapsed = time.time() - start_time
+            if best is None or elapsed < best:
+                best = elapsed
+
+        results.append(Result(codec, best, size, sample.nbytes))
+        logging.debug('codec: %s', results[-1])
+
+    return results
+
+
+def choose(results, frame_rate, workers, disk):
+    """Pick the codec that can save frames fastest.
+
+    results -- from benchmark()
+    frame_rate -- frames per second the camera delivers
+    workers -- threads or processes encoding in parallel
+    disk -- bytes per second the capture location can take
+    """
+    best = max(results, key=lambda r: r.frame_rate(workers, disk))
+
+    if best.frame_rate(workers, disk) < frame_rate:
+        logging.warning('codec: %s is fastest at %.1f fps but the camera '
+                        'runs at %.1f fps', best.codec.name,
+                        best.frame_rate(workers, disk), frame_rate)
+
+    return best.codec
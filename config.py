@@ -1,4 +1,3 @@
-import PyCapture2
 import logging
 import os
 
@@ -48,7 +47,7 @@ class Config(Gtk.Window):
         else:
             auto.hide()
 
-        if name == PyCapture2.PROPERTY_TYPE.WHITE_BALANCE:
+        if name == self.backend.PROPERTY_TYPE.WHITE_BALANCE:
             value[0].configure(p.valueA, min_val, max_val, 1, 0, 0)
             value[1].configure(p.valueB, min_val, max_val, 1, 0, 0)
         else:
@@ -81,7 +80,7 @@ class Config(Gtk.Window):
                   'onOff': onoff.get_active(),
                   'autoManualMode': auto.get_active()}
 
-        if name == PyCapture2.PROPERTY_TYPE.WHITE_BALANCE:
+        if name == self.backend.PROPERTY_TYPE.WHITE_BALANCE:
             kwargs['valueA'] = value[0].get_value()
             kwargs['valueB'] = value[1].get_value()
 
@@ -99,6 +98,7 @@ class Config(Gtk.Window):
 
         # retrieve raw camera from the camera wrapper
         self.camera = camera.camera
+        self.backend = camera.backend
         self.properties = {}
         self.refresh_timeout = 0
         self.updating = {}
@@ -106,15 +106,15 @@ class Config(Gtk.Window):
         # get all properties of the camera and exclude private members
         # output as INT: KEY instead
         self.property_types = {v: k for k, v in
-                               vars(PyCapture2.PROPERTY_TYPE).items()
+                               vars(self.backend.PROPERTY_TYPE).items()
                                if not k.startswith('_') and type(v) is int}
 
         # build properties list -- add white balance here to lock WB
         for k, v in self.property_types.items():
-            if k in (PyCapture2.PROPERTY_TYPE.TRIGGER_MODE,
-                     PyCapture2.PROPERTY_TYPE.TRIGGER_DELAY,
-                     PyCapture2.PROPERTY_TYPE.TEMPERATURE,
-                     PyCapture2.PROPERTY_TYPE.UNSPECIFIED_PROPERTY_TYPE):
+            if k in (self.backend.PROPERTY_TYPE.TRIGGER_MODE,
+                     self.backend.PROPERTY_TYPE.TRIGGER_DELAY,
+                     self.backend.PROPERTY_TYPE.TEMPERATURE,
+                     self.backend.PROPERTY_TYPE.UNSPECIFIED_PROPERTY_TYPE):
                 continue
 
             property_info = self.camera.getPropertyInfo(k)
@@ -160,7 +160,7 @@ class Config(Gtk.Window):
             max_val = p.absMax if p.absValSupported else p.max
 
             # set the adjustment corresponding to the thingus
-            if k == PyCapture2.PROPERTY_TYPE.WHITE_BALANCE:
+            if k == self.backend.PROPERTY_TYPE.WHITE_BALANCE:
                 a = (Gtk.Adjustment.new(min_val, min_val, max_val, 1, 0, 0),
                      Gtk.Adjustment.new(min_val, min_val, max_val, 1, 0, 0))
 
@@ -173,7 +173,7 @@ class Config(Gtk.Window):
             self.value_table[k] = a
 
             # slider-scale
-            if k == PyCapture2.PROPERTY_TYPE.WHITE_BALANCE:
+            if k == self.backend.PROPERTY_TYPE.WHITE_BALANCE:
                 box = Gtk.VBox.new(True, 5)
 
                 b = Gtk.Scale.new(Gtk.Orientation.HORIZONTAL, a[0])
@@ -195,7 +195,7 @@ class Config(Gtk.Window):
             grid.attach(b, 1, i, 1, 1)
 
             # spinner for finer-grained control
-            if k == PyCapture2.PROPERTY_TYPE.WHITE_BALANCE:
+            if k == self.backend.PROPERTY_TYPE.WHITE_BALANCE:
                 box = Gtk.VBox.new(True, 5)
 
                 b = Gtk.SpinButton.new(a[0], 1, 1)
@@ -0,0 +1,217 @@
+"""A single file holding every frame of a capture.
+
+The file starts with a fixed header, followed by the raw frames packed one
+after another and a trailing index with one entry per frame:
+
+    header -- magic, version, frame count, index offset, channel order
+    frames -- raw uint8 pixels as the camera delivered them, in C order,
+              each aligned to frame_align bytes
+    index -- an index_dtype record per frame
+
+Container writes a file, Reader memory-maps one and hands back zero-copy
+numpy views of the frames.
+"""
+
+import logging
+import os
+import struct
+import threading
+
+import numpy
+
+magic = b'SEALCAP\0'
+version = 1
+
+# magic, version, frame count, index offset, channel order (b'BGR', b'RGB'
+# or b'' for raw), padded to header_size
+header = struct.Struct('<8sIQQ4s')
+header_size = 64
+
+# frames start on this boundary, keeps them friendly to the page cache
+frame_align = 4096
+
+# most buffers we pass to a single pwritev
+iov_max = 1024
+
+# the file is preallocated this many bytes at a time as frames arrive
+reserve_size = 256 * 1024 * 1024
+
+index_dtype = numpy.dtype([('offset', '<u8'),
+                           ('timestamp', '<f8'),
+                           ('angle', '<f8'),
+                           ('rows', '<u4'),
+                           ('cols', '<u4'),
+                           ('channels', '<u4')])
+
+
+class Error(Exception):
+    """A damaged or unrecognised container file."""
+    pass
+
+
+def align(n):
+    return (n + frame_align - 1) // frame_align * frame_align
+
+
+def pwrite_all(fd, buffers, offset):
+    """Write buffers one after another at offset, retrying short writes."""
+    buffers = [memoryview(b).cast('B') for b in buffers]
+    first = 0
+    while first < len(buffers):
+        written = os.pwritev(fd, buffers[first:first + iov_max], offset)
+        if written == 0:
+            raise OSError('container: no progress writing at %d' % offset)
+        offset += written
+
+        # skip what went out, the rest of a partly written buffer goes next
+        while written:
+            size = len(buffers[first])
+            if written < size:
+                buffers[first] = buffers[first][written:]
+                break
+            written -= size
+            first += 1
+
+
+class Container:
+    """Append frames to a preallocated container file.
+
+    save() is safe to call from several threads: space for each frame is
+    reserved under a lock and the pixels are then written with pwritev
+    straight from the caller's array, without copying the region of interest
+    into a contiguous buffer first. The file is preallocated reserve_size
+    bytes at a time, ahead of the frames.
+    """
+
+    def __init__(self, path, frame_size=0, frames=0, order='RGB'):
+        """Create a container.
+
+        path -- the file to create
+        frame_size -- bytes in each frame
+        frames -- number of frames expected, the first reservation covers
+                  them if that is less than reserve_size
+        order -- the channel order of the frames, see camera.Frame.order
+        """
+        self.path = path
+        self.order = order
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+
+        self.lock = threading.Lock()
+        self.end = align(header_size)
+        self.reserved = 0
+        self.index = []
+
+        self.reserve(min(self.end + align(frame_size) * frames,
+                         self.end + reserve_size))
+
+        self.write_header(0, 0)
+
+    def reserve(self, end):
+        """Preallocate the file up to end bytes."""
+        if end <= self.reserved:
+            return
+
+        try:
+            os.posix_fallocate(self.fd, self.reserved, end - self.reserved)
+        except (AttributeError, OSError):
+            os.ftruncate(self.fd, end)
+
+        self.reserved = end
+
+    def write_header(self, count, index_offset):
+        data = header.pack(magic, version, count, index_offset,
+                           (self.order or '').encode('ascii'))
+        os.pwrite(self.fd, data.ljust(header_size, b'\0'), 0)
+
+    def save(self, roi, timestamp, position):
+        """Append a frame, return the container's file name and the offset
+        the frame was written at.
+
+        roi -- a uint8 array of rows x cols (x channels) pixels
+        timestamp -- seconds since the start of the capture
+        position -- degrees since the start of the capture
+        """
+        rows, cols = roi.shape[:2]
+        channels = roi.shape[2] if roi.ndim > 2 else 1
+
+        with self.lock:
+            offset = self.end
+            self.end += align(roi.nbytes)
+            if self.end > self.reserved:
+                self.reserve(max(self.end, self.reserved + reserve_size))
+            self.index.append((offset, timestamp, position,
+                               rows, cols, channels))
+
+        if roi.flags.c_contiguous:
+            pwrite_all(self.fd, [roi.data], offset)
+        else:
+            # each row of a crop is contiguous, write the rows in place
+            pwrite_all(self.fd, [row.data for row in roi], offset)
+
+        return os.path.basename(self.path), offset
+
+    def close(self):
+        """Write the index and trim the file to its final length."""
+        with self.lock:
+            index = numpy.array(sorted(self.index), dtype=index_dtype)
+            index_offset = self.end
+
+            pwrite_all(self.fd, [index.tobytes()], index_offset)
+            os.ftruncate(self.fd, index_offset + index.nbytes)
+            self.write_header(len(index), index_offset)
+
+            os.close(self.fd)
+            self.fd = -1
+
+        logging.debug('container: %d frames in %s', len(index), self.path)
+
+
+class Reader:
+    """Memory-map a container file.
+
+    reader[i] returns frame i as a read-only numpy view into the file,
+    reader.index is the structured array of offset, timestamp, angle and
+    shape for every frame and reader.order the channel order of the frames,
+    'BGR', 'RGB' or None for single channel ones.
+    """
+
+    def __init__(self, path):
+        self.map = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+
+        if len(self.map) < header_size:
+            raise Error('%s is too short to be a container' % path)
+
+        file_magic, file_version, count, index_offset, order = \
+            header.unpack_from(self.map, 0)
+
+        if file_magic != magic:
+            raise Error('%s is not a container' % path)
+        if file_version != version:
+            raise Error('%s is container version %d, expected %d' %
+                        (path, file_version, version))
+
+        self.order = order.rstrip(b'\0').decode('ascii') or None
+        if index_offset == 0:
+            raise Error('%s was not closed, it has no index' % path)
+
+        end = index_offset + count * index_dtype.itemsize
+        self.index = self.map[index_offset:end].view(index_dtype)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        entry = self.index[i]
+        offset = int(entry['offset'])
+        rows, cols, channels = (int(entry['rows']), int(entry['cols']),
+                                int(entry['channels']))
+
+        frame = self.map[offset:offset + rows * cols * channels]
+        if channels == 1:
+            return frame.reshape(rows, cols)
+
+        return frame.reshape(rows, cols, channels)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
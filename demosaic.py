@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+"""Demosaic a raw Bayer capture.
+
+Captures taken with --raw hold single channel RAW8 frames, either as one file
+per frame in any of the codec formats or in a capture.seal container. This
+turns them into colour TIFFs with the usual time_position names, spread over
+every core. Headerless .raw files take their shape from manifest.bin.
+"""
+
+import argparse
+import glob
+import logging
+import multiprocessing
+import os
+import sys
+
+import cv2
+
+import codec
+import container
+import manifest
+
+# OpenCV names Bayer patterns after the second row of the tile, so an RGGB
+# sensor needs COLOR_BAYER_BG2BGR
+bayer_codes = {
+    'RGGB': cv2.COLOR_BAYER_BG2BGR,
+    'GRBG': cv2.COLOR_BAYER_GB2BGR,
+    'GBRG': cv2.COLOR_BAYER_GR2BGR,
+    'BGGR': cv2.COLOR_BAYER_RG2BGR
+}
+
+# the tile layout of the Grasshopper3 sensor
+default_pattern = 'RGGB'
+
+# the container being demosaiced, opened once in each worker process
+reader = None
+
+# the codec that wrote each kind of per-frame file
+readers = {c.extension: c for c in codec.codecs().values()}
+
+
+def open_container(path):
+    global reader
+
+    reader = container.Reader(path)
+
+
+def demosaic_file(source, destination, code, shape):
+    raw = readers[os.path.splitext(source)[1]].load(source, shape)
+    cv2.imwrite(destination, cv2.cvtColor(raw, code))
+
+
+def demosaic_frame(i, output, code):
+    entry = reader.index[i]
+    image_name = "%s_%s.tiff" % (float(entry['timestamp']),
+                                 float(entry['angle']))
+
+    cv2.imwrite(os.path.join(output, image_name),
+                cv2.cvtColor(reader[i], code))
+
+
+def demosaic(source, output, pattern=default_pattern, processes=None):
+    """Demosaic every frame of a capture.
+
+    source -- the capture directory
+    output -- directory for the colour TIFFs
+    pattern -- the sensor's Bayer tile layout, one of bayer_codes
+    processes -- worker processes, defaults to one per core
+    """
+    code = bayer_codes[pattern]
+    os.makedirs(output, exist_ok=True)
+
+    path = os.path.join(source, 'capture.seal')
+
+    if os.path.exists(path):
+        count = len(container.Reader(path))
+
+        with multiprocessing.Pool(processes, open_container,
+                                  (path, )) as pool:
+            pool.starmap(demosaic_frame,
+                         ((i, output, code) for i in range(count)))
+    else:
+        names = sorted(name for name in glob.glob(os.path.join(source, '*'))
+                       if os.path.splitext(name)[1] in readers)
+        count = len(names)
+
+        # every frame of a capture has the same shape, raw files need it
+        shape = None
+        manifest_path = os.path.join(source, manifest.name)
+        if os.path.exists(manifest_path):
+            frames = manifest.load(manifest_path)
+            if len(frames):
+                shape = (int(frames['height'][0]), int(frames['width'][0]))
+
+        with multiprocessing.Pool(processes) as pool:
+            pool.starmap(demosaic_file,
+                         ((name, os.path.join(output, os.path.splitext(
+                             os.path.basename(name))[0] + '.tiff'),
+                           code, shape) for name in names))
+
+    logging.debug('demosaic: %d frames from %s', count, source)
+
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Demosaic a raw Bayer '
+                                                 'capture.')
+    parser.add_argument('source', help='capture directory')
+    parser.add_argument('--output',
+                        help='directory for the colour TIFFs '
+                             '(default: SOURCE/demosaiced)')
+    parser.add_argument('--pattern', choices=sorted(bayer_codes),
+                        default=default_pattern,
+                        help='Bayer tile layout of the sensor '
+                             '(default: %s)' % default_pattern)
+    parser.add_argument('--processes', type=int,
+                        help='worker processes (default: one per core)')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.source):
+        sys.exit("%s is not a capture directory" % args.source)
+
+    output = args.output or os.path.join(args.source, 'demosaiced')
+    count = demosaic(args.source, output, args.pattern, args.processes)
+    print("%d frames written to %s" % (count, output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import concurrent.futures
+import functools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from multiprocessing import shared_memory
+
+import numpy
+
+# encoder processes, leave a couple of cores for the camera and the GUI
+default_encoders = max(1, (os.cpu_count() or 1) - 2)
+
+# slots in the shared memory ring, each holds one region of interest
+default_slots = 16
+
+# the ring, attached once in each encoder process
+ring = None
+
+
+def attach(name):
+    global ring
+
+    try:
+        ring = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before Python 3.13 attaching always registers the ring with the
+        # resource tracker, which then warns about a leak or unlinks it while
+        # the capture still uses it -- the parent owns it, so skip that
+        from multiprocessing import resource_tracker
+
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            ring = shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def encode(slot, shape, path, codec, order):
+    size = int(numpy.prod(shape))
+    roi = numpy.ndarray(shape, numpy.uint8, ring.buf, slot * size)
+
+    codec.save(path, roi, order)
+
+
+class Encoder:
+    """Compress captured frames on a pool of processes.
+
+    Each frame is copied once into a slot of a shared memory ring. Only the
+    slot index and the (small) codec.Codec cross to the encoder process,
+    which compresses and writes the slot and hands the slot back.
+
+    This has the same interface as writer.Writer: when every slot is busy
+    put() blocks and the time spent waiting is recorded as back-pressure.
+    """
+
+    def __init__(self, location, shape, codec, encoders=default_encoders,
+                 slots=default_slots, manifest=None, order='RGB'):
+        self.location = location
+        self.manifest = manifest
+        self.shape = tuple(shape)
+        self.codec = codec
+        self.order = order
+
+        self.slot_size = int(numpy.prod(self.shape))
+        self.ring = shared_memory.SharedMemory(create=True,
+                                               size=self.slot_size * slots)
+
+        self.free = queue.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        self.slots = slots
+
+        # statistics, updated by put() and the completion callbacks
+        self.lock = threading.Lock()
+        self.max_depth = 0
+        self.written = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+
+        # spawn, as forking a threaded GTK process is asking for trouble
+        context = multiprocessing.get_context('spawn')
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            encoders, mp_context=context,
+            initializer=attach, initargs=(self.ring.name,))
+
+    def done(self, slot, record, future):
+        try:
+            future.result()
+
+            if self.manifest:
+                self.manifest.append(*record)
+
+            with self.lock:
+                self.written += 1
+        except Exception:
+            logging.exception('encoder: unable to save frame')
+        finally:
+            self.free.put(slot)
+
+    def put(self, roi, timestamp, position, frame=None):
+        """Queue a frame for saving.
+
+        roi -- the pixels to save, copied into the ring before returning
+        timestamp -- seconds since the start of the capture
+        position -- degrees since the start of the capture
+        frame -- the camera.Frame roi points into, not needed after the copy
+        """
+        try:
+            slot = self.free.get_nowait()
+        except queue.Empty:
+            start_time = time.time()
+            slot = self.free.get()
+
+            with self.lock:
+                self.stalls += 1
+                self.stall_time += time.time() - start_time
+
+        view = numpy.ndarray(self.shape, numpy.uint8, self.ring.buf,
+                             slot * self.slot_size)
+        view[...] = roi
+        del view
+
+        image_name = "%s_%s%s" % (timestamp, position, self.codec.extension)
+        image_path = os.path.join(self.location, image_name)
+
+        future = self.pool.submit(encode, slot, self.shape, image_path,
+                                  self.codec, self.order)
+        if frame is not None:
+            record = (frame.index, timestamp, frame.host_time, position,
+                      image_name)
+        else:
+            record = (-1, timestamp, 0.0, position, image_name)
+
+        future.add_done_callback(functools.partial(self.done, slot, record))
+
+        depth = self.depth
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    @property
+    def depth(self):
+        """Number of frames waiting to be saved."""
+        return self.slots - self.free.qsize()
+
+    def close(self):
+        """Save any queued frames, stop the encoder processes and close the
+        manifest.
+        """
+        self.pool.shutdown(wait=True)
+
+        self.ring.close()
+        self.ring.unlink()
+
+        if self.manifest:
+            self.manifest.close()
+
+        logging.debug('encoder: %d frames, max depth %d, '
+                      '%d stalls (%.3fs)',
+                      self.written, self.max_depth,
+                      self.stalls, self.stall_time)
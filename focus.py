@@ -52,7 +52,7 @@ class Focus(Gtk.Window):
 
         self.image.set_app_paintable(True)
 
-        self.frame_buffer = None
+        self.frame_index = -1
         self.preview_timeout = GLib.timeout_add(frame_timeout, self.live_cb)
         self.fps_timeout = GLib.timeout_add(1000, self.fps_cb)
         self.camera = camera
@@ -71,12 +71,16 @@ class Focus(Gtk.Window):
         logging.debug('grabbing frame ..')
         frame = self.camera.focus()
 
-        if self.frame_buffer is frame:
+        if frame is None:
+            return
+
+        if frame.index == self.frame_index:
+            frame.release()
             return
 
         start_time = time.time()
 
-        score = cv2.Laplacian(cv2.cvtColor(frame['array'], cv2.COLOR_RGB2GRAY), cv2.CV_64F).var()
+        score = cv2.Laplacian(cv2.cvtColor(frame.array, camera.gray_codes[frame.order]), cv2.CV_64F).var()
         # cv2.putText(frame['array'],
         #             "Score: {:.2f}".format(score),
         #             (10, 30),
@@ -126,5 +130,6 @@ class Focus(Gtk.Window):
         #
         # self.image.set_from_pixbuf(pixbuf)
 
-        self.frame_buffer = frame
+        self.frame_index = frame.index
+        frame.release()
         self.frame += 1
@@ -3,12 +3,13 @@ import logging
 import time
 import sys
 import cv2
-import queue
+import numpy
 
 import argparse
-import PyCapture2
 
 from thorpy.comm.discovery import discover_stages
+from thorpy.comm.recorder import Recorder
+from thorpy.comm.virtual import VirtualController
 from thorpy.message import *
 
 import preview
@@ -18,6 +19,13 @@ import info
 import focus
 import rect
 import config
+import writer
+import encoder
+import container
+import binning
+import codec
+import manifest
+import synthetic
 
 import gi
 
@@ -30,6 +38,17 @@ preview_width = 1060
 # capture offset, to give turntable time to reach velocity
 capture_offset = 10
 
+# stage status requests per second while capturing, for frame angles
+capture_position_rate = 50
+
+# threads saving captured frames, and frames allowed to queue up for them
+capture_writers = 4
+capture_queue_size = 16
+
+# frames expected in a capture container, the file is preallocated in chunks
+# (container.reserve_size) as it grows, so this only sizes the first one
+container_frames = 1000
+
 # initialise GObject Threads
 GObject.threads_init()
 
@@ -61,18 +80,26 @@ class MainWindow(Gtk.Window):
             self.config_window.set_modal(True)
             self.config_window.show()
 
-    def capture_task(self, image):
-        position = self.stage.position
+    def capture_task(self, frame):
+        # the angle when the frame arrived, not the last status update
+        position = self.stage.position_at(frame.host_time)
 
-        stop = self.progress.progress(1 -
-                                      (self.capture_position - position) /
-                                      (360 + capture_offset))
+        # no status update from the stage yet, so no angle for this frame
+        if numpy.isnan(position):
+            return
 
-        if stop or self.stage.position >= self.capture_position:
+        # this is the camera thread, only publish, the main loop draws
+        self.capture_frames += 1
+        stop = self.progress.publish(1 -
+                                     (self.capture_position - position) /
+                                     (360 + capture_offset),
+                                     self.capture_frames)
+
+        if stop or position >= self.capture_position:
             self.capture_stop()
+            return
 
-        timestamp = image.getTimeStamp()
-        image_time = timestamp.seconds + timestamp.microSeconds * 1e-6
+        image_time = frame.seconds + frame.microSeconds * 1e-6
 
         if self.capture_start_time is None:
             self.capture_start_time = image_time
@@ -84,26 +111,32 @@ class MainWindow(Gtk.Window):
 
         position = position - self.capture_start_pos
 
-        image_name = "%s_%s.tiff" % (image_time, position)
-        image_path = os.path.join(self.capture_location, image_name)
+        roi = self.capture_crop
 
-        roi = self.capture_selection
+        roi = frame.array[roi.top:roi.top + roi.height,
+                          roi.left:roi.left + roi.width]
 
-        image_data = image.__array__()
-        roi = image_data[roi.top:roi.top + roi.height,
-                         roi.left:roi.left + roi.width]
+        if self.capture_binner:
+            # hold the frame while it is a candidate for its angle bin
+            frame.acquire()
+            self.capture_binner.add(position,
+                                    (roi, image_time, position, frame))
+        else:
+            self.capture_keep((roi, image_time, position, frame))
 
-        roi = cv2.cvtColor(roi, cv2.COLOR_RGB2BGR)
-        cv2.imwrite(image_path, roi)
-        # self.capture_image_queue.put_nowait((image_path, roi))
+    def capture_keep(self, item):
+        # conversion and saving happen on the writer threads, which hold
+        # the frame until it is on disk
+        self.capture_writer.put(*item)
 
-        # tested PyCapture2.Image.save -- equally as slow as cv2.imwrite
-        # image.save(image_path.encode('ascii'),
-        #            PyCapture2.IMAGE_FILE_FORMAT.TIFF)
+    def capture_binned(self, item):
+        # the writer holds the frame now, drop the binner's reference
+        self.capture_keep(item)
+        self.capture_drop(item)
 
-        # if position == 0 and image_time == 0:
-        #     # start the capture queue
-        #     GLib.idle_add(self.capture_save_cb)
+    def capture_drop(self, item):
+        roi, image_time, position, frame = item
+        frame.release()
 
     def capture_start(self):
         max_velocity = self.max_velocity.get_value()
@@ -120,9 +153,31 @@ class MainWindow(Gtk.Window):
         self.capture_position = self.stage.position + 360 + capture_offset
         self.capture_selection = self.preview.get_selection()
 
-        # 5 degree offset to make sure position exceeds
-        self.stage.position = self.capture_position + 1
-        self.camera.callback = self.capture_task
+        selection = self.capture_selection
+        if self.args.raw:
+            # crop on whole 2x2 Bayer tiles so demosaicing lines up
+            selection.left -= selection.left % 2
+            selection.top -= selection.top % 2
+            selection.width -= selection.width % 2
+            selection.height -= selection.height % 2
+            shape = (selection.height, selection.width)
+        else:
+            shape = (selection.height, selection.width, 3)
+
+        # the live preview would switch the camera back to preview mode
+        self.preview.set_live(False)
+        readout = self.camera.capture(self.args.raw,
+                                      selection if self.args.sensor_roi
+                                      else None)
+
+        # BGR if the camera can do it, so frames are saved as they are
+        order = self.camera.order
+
+        # where the selection sits in the frames we will be sent
+        self.capture_crop = rect.Rect(selection.left - readout.left,
+                                      selection.top - readout.top,
+                                      selection.width,
+                                      selection.height)
 
         # folder timestamp...
         capture_type = "directLED" if self.direct_led.get_active() else "structuredLight"
@@ -132,32 +187,127 @@ class MainWindow(Gtk.Window):
                                              timestamp)
         os.makedirs(self.capture_location)
 
+        # one row per saved frame, so nobody needs to parse the file names
+        shutter, gain = self.camera.exposure()
+        manifest_path = os.path.join(self.capture_location, manifest.name)
+        capture_manifest = manifest.Manifest(manifest_path, selection,
+                                             shutter, gain, order)
+
+        # compressed captures need more CPU than threads can give us
+        if self.args.encoders > 0:
+            self.capture_writer = encoder.Encoder(self.capture_location,
+                                                  shape,
+                                                  self.choose_codec(
+                                                      shape,
+                                                      self.args.encoders),
+                                                  self.args.encoders,
+                                                  manifest=capture_manifest,
+                                                  order=order)
+        elif self.args.container:
+            output = container.Container(os.path.join(self.capture_location,
+                                                      'capture.seal'),
+                                         int(numpy.prod(shape)),
+                                         container_frames, order)
+            self.capture_writer = writer.Writer(output,
+                                                capture_writers,
+                                                capture_queue_size,
+                                                capture_manifest)
+        else:
+            output = writer.Files(self.capture_location,
+                                  self.choose_codec(shape, capture_writers),
+                                  order)
+            self.capture_writer = writer.Writer(output,
+                                                capture_writers,
+                                                capture_queue_size,
+                                                capture_manifest)
+
+        # keep one frame per angular step, if asked to
+        if self.args.step > 0:
+            self.capture_binner = binning.AngleBinner(self.args.step,
+                                                      self.capture_binned,
+                                                      self.capture_drop)
+        else:
+            self.capture_binner = None
+
         # used to normalise start and end times
         self.capture_start_pos = None
         self.capture_start_time = None
+        self.capture_frames = 0
 
-    def capture_stop(self):
-        self.progress.stop()
-        self.toolbar.set_sensitive(True)
-        self.preview.set_sensitive(True)
+        # start the turntable only once saving is set up, choosing a codec
+        # can take a few seconds
+        # 5 degree offset to make sure position exceeds
+        self.stage.position = self.capture_position + 1
+        self.stage.start_position_stream(capture_position_rate)
+
+        # everything is ready, start handing frames to capture_task
+        self.camera.callback = self.capture_task
+
+    def choose_codec(self, shape, workers):
+        codecs = codec.codecs(self.args.png_level)
+
+        if self.args.codec != 'auto':
+            return codecs[self.args.codec]
+
+        # benchmark once per session, frame shape and channel order, it
+        # takes a while
+        frame = self.camera.latest()
+        key = (shape, frame.order)
+        if key not in self.codec_results:
+            crop = self.capture_crop
+            sample = frame.array[crop.top:crop.top + crop.height,
+                                 crop.left:crop.left + crop.width].copy()
+
+            self.codec_results[key] = codec.benchmark(sample,
+                                                      codecs.values(),
+                                                      order=frame.order)
+        frame.release()
+
+        if self.disk_speed is None:
+            self.disk_speed = codec.disk_speed(self.capture_location)
 
+        chosen = codec.choose(self.codec_results[key],
+                              self.camera.frame_rate(),
+                              workers,
+                              self.disk_speed)
+        logging.debug('capture: saving with %s', chosen.name)
+
+        return chosen
+
+    def capture_stop(self):
         # stop camera callback from triggering processing
         self.camera.callback = None
 
         # stop the stage from moving
         self.stage.stop()
+        self.stage.stop_position_stream()
 
-    def capture_save_cb(self):
-        empty = self.capture_image_queue.empty()
+        # the last bin has no later frame to close it
+        if self.capture_binner:
+            self.capture_binner.flush()
+            self.capture_binner = None
 
-        if not self.camera.callback and empty:
-            return False
+        # wait for the queued frames to reach the disk
+        capture_writer = self.capture_writer
+        self.capture_writer = None
+        capture_writer.close()
 
-        if not empty:
-            data = self.capture_image_queue.get_nowait()
-            cv2.imwrite(*data)
+        # we are on the camera thread, leave the widgets to the main loop
+        GLib.idle_add(self.capture_done_cb, capture_writer)
 
-        return True
+    def capture_done_cb(self, capture_writer):
+        self.progress.stop()
+        self.toolbar.set_sensitive(True)
+        self.preview.set_sensitive(True)
+        self.preview.set_live(True)
+
+        self.info.msg('Capture Complete',
+                      '%d frames saved, queue depth peaked at %d, '
+                      'camera held back %d times (%.2fs)' %
+                      (capture_writer.written, capture_writer.max_depth,
+                       capture_writer.stalls, capture_writer.stall_time))
+
+        return False
 
     def capture_cb(self, widget, data=None):
         selection = self.preview.get_selection()
@@ -193,7 +343,7 @@ class MainWindow(Gtk.Window):
             self.focus_window.show()
 
 
-    def __init__(self, working_dir):
+    def __init__(self, working_dir, args):
         Gtk.Window.__init__(self)
         self.connect('destroy', self.destroy_cb)
         self.set_position(Gtk.WindowPosition.CENTER_ALWAYS)
@@ -202,7 +352,22 @@ class MainWindow(Gtk.Window):
         self.set_title(working_dir)
         os.chdir(working_dir)
 
-        self.stage = next(discover_stages(), None)
+        self.args = args
+
+        if args.virtual_stage:
+            # a simulated turntable controller on a pseudo-terminal
+            self.virtual_stage = VirtualController()
+            ports = [(self.virtual_stage.port,
+                      self.virtual_stage.serial_number)]
+        else:
+            self.virtual_stage = None
+            ports = None
+
+        # every message to and from the turntable, handshake included, read
+        # it with thorpy.comm.recorder.load()
+        recorder = Recorder(args.stage_log) if args.stage_log else None
+
+        self.stage = next(discover_stages(ports, recorder=recorder), None)
 
         if self.stage is None:
             sys.exit("unable to locate THORLABS stage")
@@ -211,15 +376,21 @@ class MainWindow(Gtk.Window):
         self.config_window = None
 
         self.capture_selection = None
+        self.capture_crop = None
         self.capture_position = None
         self.capture_location = None
+        self.capture_writer = None
+        self.capture_binner = None
+
+        # codec benchmarks, by frame shape and channel order, and the speed
+        # of the disk
+        self.codec_results = {}
+        self.disk_speed = None
 
         # used to normalise start and end times
         self.capture_start_pos = None
         self.capture_start_time = None
-
-        # queue for image saving to not compromise fps
-        self.capture_image_queue = queue.Queue()
+        self.capture_frames = 0
 
         self.vbox = Gtk.VBox(False, 0)
         self.add(self.vbox)
@@ -229,7 +400,12 @@ class MainWindow(Gtk.Window):
         self.vbox.pack_start(fixed, False, True, 0)
         fixed.show()
 
-        self.camera = camera.Camera()
+        if args.synthetic:
+            backend = synthetic.Backend(frame_rate=args.synthetic_rate,
+                                        replay=args.replay)
+        else:
+            backend = None
+        self.camera = camera.Camera(backend)
         self.preview = preview.Preview(self.camera)
         fixed.put(self.preview, 0, 0)
         self.preview.show()
@@ -323,6 +499,49 @@ class MainWindow(Gtk.Window):
         Gtk.main()
 
 def main():
+    parser = argparse.ArgumentParser(description='Capture a seal on the '
+                                                 'turntable.')
+    parser.add_argument('--encoders', type=int, default=0,
+                        help='save captures with this many encoder '
+                             'processes, 0 saves on threads instead '
+                             '(default: 0)')
+    parser.add_argument('--codec', choices=sorted(codec.codecs()) + ['auto'],
+                        default='auto',
+                        help='format for captured frames, auto benchmarks '
+                             'them all and picks the fastest '
+                             '(default: auto)')
+    parser.add_argument('--png-level', type=int,
+                        default=codec.default_png_level,
+                        help='PNG compression level, 1-9 (default: %d)' %
+                             codec.default_png_level)
+    parser.add_argument('--container', action='store_true',
+                        help='append raw frames to a single capture.seal '
+                             'file instead of one file per frame')
+    parser.add_argument('--raw', action='store_true',
+                        help='capture RAW8 Bayer frames, run demosaic.py on '
+                             'the capture afterwards')
+    parser.add_argument('--step', type=float, default=0,
+                        help='keep only the frame closest to each multiple '
+                             'of this many degrees, 0 keeps every frame '
+                             '(default: 0)')
+    parser.add_argument('--sensor-roi', action='store_true',
+                        help='read only the selection out of the sensor, '
+                             'for a higher frame rate')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='use a simulated camera instead of PyCapture2')
+    parser.add_argument('--synthetic-rate', type=float,
+                        default=synthetic.default_frame_rate,
+                        help='frames per second from the simulated camera '
+                             '(default: %d)' % synthetic.default_frame_rate)
+    parser.add_argument('--replay',
+                        help='directory of images for the simulated camera '
+                             'to play back')
+    parser.add_argument('--virtual-stage', action='store_true',
+                        help='use a simulated turntable controller')
+    parser.add_argument('--stage-log',
+                        help='record all turntable traffic to this file')
+    args = parser.parse_args()
+
     # Prompt user for Working Directory
     chooser = Gtk.FileChooserDialog(title="Imaging Folder Selection",
                                     action=Gtk.FileChooserAction.SELECT_FOLDER,
@@ -335,7 +554,7 @@ def main():
         filename = chooser.get_filename()
         chooser.destroy()
 
-        window = MainWindow(filename)
+        window = MainWindow(filename, args)
         window.main()
     else:
         sys.exit("no folder chosen")
@@ -0,0 +1,83 @@
+"""Per-frame metadata for a capture.
+
+Every saved frame appends one fixed-size record to manifest.bin in the
+capture directory, so the timing and angle of each frame can be recovered
+without parsing file names:
+
+    frames = manifest.load(os.path.join(capture_location, 'manifest.bin'))
+    frames['angle']
+"""
+
+import threading
+
+import numpy
+
+name = 'manifest.bin'
+
+dtype = numpy.dtype([('index', '<i8'),         # frame number, by arrival
+                     ('camera_time', '<f8'),   # seconds since capture start
+                     ('host_time', '<f8'),     # time.monotonic() on arrival
+                     ('angle', '<f8'),         # degrees since capture start
+                     ('left', '<i4'),          # region of interest
+                     ('top', '<i4'),
+                     ('width', '<i4'),
+                     ('height', '<i4'),
+                     ('shutter', '<f4'),       # ms
+                     ('gain', '<f4'),          # dB
+                     ('file', 'S64'),          # relative to the capture
+                     ('offset', '<i8'),        # into file, or -1
+                     ('order', 'S3')])         # b'BGR', b'RGB' or b'' (raw)
+
+
+class Manifest:
+    """Stream manifest records to a file as frames are saved.
+
+    Safe to call append() from several threads, records are written
+    unbuffered so an interrupted capture keeps every row up to that point.
+    """
+
+    def __init__(self, path, roi, shutter, gain, order='RGB'):
+        """Startup.
+
+        path -- the file to create
+        roi -- the rect.Rect cropped from each frame
+        shutter, gain -- the camera settings for the whole capture
+        order -- the channel order of the saved pixels, see camera.Frame.order
+        """
+        self.path = path
+        self.file = open(path, 'wb', buffering=0)
+        self.lock = threading.Lock()
+
+        self.record = numpy.zeros(1, dtype)
+        self.record['left'] = roi.left
+        self.record['top'] = roi.top
+        self.record['width'] = roi.width
+        self.record['height'] = roi.height
+        self.record['shutter'] = shutter
+        self.record['gain'] = gain
+        self.record['order'] = order or ''
+
+        self.count = 0
+
+    def append(self, index, camera_time, host_time, angle, file='',
+               offset=-1):
+        with self.lock:
+            record = self.record
+            record['index'] = index
+            record['camera_time'] = camera_time
+            record['host_time'] = host_time
+            record['angle'] = angle
+            record['file'] = file
+            record['offset'] = offset
+
+            self.file.write(record.data)
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def load(path):
+    """Return the records in a manifest as a numpy structured array."""
+    return numpy.fromfile(path, dtype)
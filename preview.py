@@ -10,6 +10,7 @@ from gi.repository import Gtk, Gdk, GdkPixbuf, GLib
 gi.require_version('Vips', '8.0')
 from gi.repository import Vips
 
+import camera
 import rect
 import time
 
@@ -222,7 +223,7 @@ class Preview(Gtk.EventBox):
         self.image.set_app_paintable(True)
 
         self.frame_image = None
-        self.frame_buffer = None
+        self.frame_index = -1
         self.preview_timeout = 0
         self.camera = camera
         self.frame = 0
@@ -245,13 +246,22 @@ class Preview(Gtk.EventBox):
         logging.debug('grabbing frame ..')
         frame = self.camera.preview()
 
-        if self.frame_buffer is frame:
+        if frame is None:
+            return
+
+        if frame.index == self.frame_index:
+            frame.release()
             return
 
         start_time = time.time()
 
-        image = np.copy(frame['array'])
+        # work from the pooled buffer directly, the frame is ours until
+        # we release it
+        image = frame.array
         small = cv2.resize(image, None, fx=scale, fy=scale)
+        if frame.order == 'BGR':
+            # only the thumbnail needs to be RGB, for the pixbuf
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
         height, width, channels = small.shape
         self.frame_image = small.tobytes()
 
@@ -262,9 +272,15 @@ class Preview(Gtk.EventBox):
         else:
             roi = small
 
-        roi = cv2.cvtColor(roi, cv2.COLOR_RGB2GRAY)
+        if roi is small:
+            roi = cv2.cvtColor(roi, cv2.COLOR_RGB2GRAY)
+        else:
+            roi = cv2.cvtColor(roi, camera.gray_codes[frame.order])
         score = cv2.Laplacian(roi, cv2.CV_32F).var()
 
+        self.frame_index = frame.index
+        frame.release()
+
         self.score_label.set_text("Score: {:.2f}".format(score))
 
         # try:
@@ -295,7 +311,6 @@ class Preview(Gtk.EventBox):
 
         self.image.set_from_pixbuf(pixbuf)
 
-        self.frame_buffer = frame
         self.frame += 1
 
     def get_live(self):
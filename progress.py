@@ -2,6 +2,9 @@ import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, GLib
 
+# milliseconds between redraws of progress published from other threads
+refresh_timeout = 100
+
 class Progress(Gtk.InfoBar):
 
     def cancel_cb(self ,widget, response_id, client):
@@ -12,6 +15,12 @@ class Progress(Gtk.InfoBar):
 
         self.cancel = False
 
+        # (fraction, count) set by publish(), replaced as a whole so other
+        # threads never see a half-updated value
+        self.message = ''
+        self.published = None
+        self.refresh_timeout = 0
+
         content = self.get_content_area()
 
         self.progressbar = Gtk.ProgressBar()
@@ -24,10 +33,36 @@ class Progress(Gtk.InfoBar):
 
 
     def start(self, message):
+        self.message = message
+        self.published = None
         self.progressbar.set_text(message)
         self.progressbar.set_fraction(0)
         self.show()
 
+        if not self.refresh_timeout:
+            self.refresh_timeout = GLib.timeout_add(refresh_timeout,
+                                                    self.refresh_cb)
+
+    def refresh_cb(self):
+        published = self.published
+
+        if published is not None:
+            fraction, count = published
+            self.progressbar.set_fraction(min(max(fraction, 0), 1))
+            self.progressbar.set_text('%s %d frames' % (self.message, count))
+
+        return True
+
+    def publish(self, fraction, count=0):
+        """Report progress from any thread.
+
+        Nothing is drawn here, the main loop picks up the latest value every
+        refresh_timeout milliseconds. Return True if the user has cancelled.
+        """
+        self.published = (fraction, count)
+
+        return self.cancel
+
     def progress(self, fraction):
         self.progressbar.set_fraction(fraction)
 
@@ -37,5 +72,9 @@ class Progress(Gtk.InfoBar):
         return self.cancel
 
     def stop(self):
+        if self.refresh_timeout:
+            GLib.source_remove(self.refresh_timeout)
+            self.refresh_timeout = 0
+
         self.hide()
         self.cancel = False
@@ -0,0 +1,487 @@
+"""A simulated camera with the same interface as PyCapture2.
+
+Hand a Backend to camera.Camera in place of the PyCapture2 module and the
+capture, preview and focus paths run without a Grasshopper3:
+
+    backend = synthetic.Backend(frame_rate=60, replay='some/frames')
+    cam = camera.Camera(backend)
+
+Only the parts of PyCapture2 that camera.py and config.py use are here.
+Frames are delivered on a thread through startCapture(callback) at the
+configured rate, with camera timestamps on a regular clock. A callback that
+falls behind makes the camera skip frames, as a real camera in DROP_FRAMES
+grab mode would.
+"""
+
+import glob
+import logging
+import os
+import threading
+import time
+
+import cv2
+import numpy
+
+# the Grasshopper3 GS3-U3-120S6C
+default_width = 4240
+default_height = 2824
+default_frame_rate = 31
+
+# distinct generated frames to cycle through
+default_frames = 4
+
+# pixel formats the simulated sensor can deliver
+default_formats = ('BGR', 'RGB', 'RAW8', 'MONO8')
+
+# Format7 unit sizes, as reported by the real camera
+offset_step = 8
+image_step = 16
+
+
+class Fc2error(Exception):
+    pass
+
+
+class MODE:
+    MODE_0 = 0
+
+
+# values from the FlyCapture2 headers
+class PIXEL_FORMAT:
+    MONO8 = 0x80000000
+    RAW8 = 0x00400000
+    RGB = 0x40000000
+    BGR = 0x80000008
+
+
+class PROPERTY_TYPE:
+    BRIGHTNESS = 0
+    AUTO_EXPOSURE = 1
+    SHARPNESS = 2
+    WHITE_BALANCE = 3
+    HUE = 4
+    SATURATION = 5
+    GAMMA = 6
+    IRIS = 7
+    FOCUS = 8
+    ZOOM = 9
+    PAN = 10
+    TILT = 11
+    SHUTTER = 12
+    GAIN = 13
+    TRIGGER_MODE = 14
+    TRIGGER_DELAY = 15
+    FRAME_RATE = 16
+    TEMPERATURE = 17
+    UNSPECIFIED_PROPERTY_TYPE = 18
+
+
+class Format7ImageSettings:
+    def __init__(self, mode, offsetX, offsetY, width, height, pixelFormat):
+        self.mode = mode
+        self.offsetX = offsetX
+        self.offsetY = offsetY
+        self.width = width
+        self.height = height
+        self.pixelFormat = pixelFormat
+
+
+class Format7Info:
+    def __init__(self, width, height, formats):
+        self.mode = MODE.MODE_0
+        self.maxWidth = width
+        self.maxHeight = height
+        self.offsetHStepSize = offset_step
+        self.offsetVStepSize = offset_step
+        self.imageHStepSize = image_step
+        self.imageVStepSize = image_step
+        self.pixelFormatBitField = 0
+        for name in formats:
+            self.pixelFormatBitField |= getattr(PIXEL_FORMAT, name)
+
+
+class Format7PacketInfo:
+    def __init__(self, recommendedBytesPerPacket):
+        self.recommendedBytesPerPacket = recommendedBytesPerPacket
+        self.maxBytesPerPacket = recommendedBytesPerPacket
+        self.unitBytesPerPacket = 4
+
+
+class TimeStamp:
+    def __init__(self, seconds, microSeconds):
+        self.seconds = seconds
+        self.microSeconds = microSeconds
+
+
+class Image:
+    """A delivered frame, the pixels are only valid during the callback."""
+
+    def __init__(self, array, timestamp):
+        self.array = array
+        self.timestamp = timestamp
+
+    def __array__(self, dtype=None, copy=None):
+        return self.array
+
+    def getCols(self):
+        return self.array.shape[1]
+
+    def getRows(self):
+        return self.array.shape[0]
+
+    def getStride(self):
+        return self.array.strides[0]
+
+    def getDataSize(self):
+        return self.array.nbytes
+
+    def getTimeStamp(self):
+        return self.timestamp
+
+
+class Property:
+    def __init__(self, type, absValue=0.0, valueA=0, valueB=0,
+                 onOff=True, autoManualMode=False):
+        self.type = type
+        self.present = True
+        self.absControl = True
+        self.absValue = absValue
+        self.valueA = valueA
+        self.valueB = valueB
+        self.onOff = onOff
+        self.autoManualMode = autoManualMode
+
+
+class PropertyInfo:
+    def __init__(self, type, absMin=0.0, absMax=0.0, unitAbbr=b'',
+                 present=True):
+        self.type = type
+        self.present = present
+        self.absValSupported = True
+        self.absMin = absMin
+        self.absMax = absMax
+        self.min = int(absMin)
+        self.max = int(absMax)
+        self.onOffSupported = False
+        self.autoSupported = False
+        self.unitAbbr = unitAbbr
+
+
+def load_frames(path, width, height):
+    """Load the images in a directory as BGR frames of the sensor size."""
+    names = sorted(name for name in glob.glob(os.path.join(path, '*'))
+                   if os.path.splitext(name)[1].lower() in
+                   ('.png', '.tif', '.tiff', '.jpg', '.jpeg', '.bmp'))
+
+    frames = []
+    for name in names:
+        image = cv2.imread(name, cv2.IMREAD_COLOR)
+        if image is None:
+            continue
+
+        if image.shape[:2] != (height, width):
+            image = cv2.resize(image, (width, height))
+
+        frames.append(image)
+
+    if not frames:
+        raise Fc2error('No frames to replay in %s' % path)
+
+    logging.debug('synthetic: replaying %d frames from %s', len(frames), path)
+
+    return frames
+
+
+def generate_frames(width, height, count=default_frames):
+    """Make count BGR frames with enough texture to score and compress
+    realistically: smooth gradients, a sharp grid and some sensor noise,
+    shifted a little on each frame as if the subject were turning.
+    """
+    y, x = numpy.mgrid[0:height, 0:width]
+    base = numpy.empty((height, width, 3), numpy.uint8)
+    base[..., 0] = (x * 255 // max(width - 1, 1))
+    base[..., 1] = (y * 255 // max(height - 1, 1))
+    base[..., 2] = 128
+    base[(x % 64 < 2) | (y % 64 < 2)] = 255
+    del x, y
+
+    rng = numpy.random.default_rng(0)
+    frames = []
+    for i in range(count):
+        frame = numpy.roll(base, i * 16, axis=1)
+        noise = rng.integers(0, 8, frame.shape, numpy.uint8)
+        frames.append(cv2.add(frame, noise))
+
+    return frames
+
+
+def mosaic(bgr):
+    """RGGB Bayer tiles from a BGR image, as the sensor would deliver."""
+    raw = numpy.empty(bgr.shape[:2], numpy.uint8)
+    raw[0::2, 0::2] = bgr[0::2, 0::2, 2]
+    raw[0::2, 1::2] = bgr[0::2, 1::2, 1]
+    raw[1::2, 0::2] = bgr[1::2, 0::2, 1]
+    raw[1::2, 1::2] = bgr[1::2, 1::2, 0]
+
+    return raw
+
+
+def convert(bgr, pixel_format):
+    """Turn a BGR image into pixel_format."""
+    if pixel_format == PIXEL_FORMAT.BGR:
+        return numpy.ascontiguousarray(bgr)
+    elif pixel_format == PIXEL_FORMAT.RGB:
+        return numpy.ascontiguousarray(bgr[..., ::-1])
+    elif pixel_format == PIXEL_FORMAT.RAW8:
+        return mosaic(bgr)
+    elif pixel_format == PIXEL_FORMAT.MONO8:
+        return cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+
+    raise Fc2error('Pixel format %#x not supported' % pixel_format)
+
+
+class Backend:
+    """Stands in for the PyCapture2 module.
+
+    width, height -- sensor size in pixels
+    frame_rate -- frames per second, can be changed later with the
+        FRAME_RATE property
+    formats -- names of the PIXEL_FORMAT values the sensor supports, drop
+        'BGR' to test the RGB fallback
+    replay -- a directory of images to play back in a loop instead of
+        generated frames
+    cameras -- how many cameras the bus reports
+    """
+
+    Fc2error = Fc2error
+    MODE = MODE
+    PIXEL_FORMAT = PIXEL_FORMAT
+    PROPERTY_TYPE = PROPERTY_TYPE
+    Format7ImageSettings = Format7ImageSettings
+
+    def __init__(self, width=default_width, height=default_height,
+                 frame_rate=default_frame_rate, formats=default_formats,
+                 replay=None, cameras=1):
+        self.width = width
+        self.height = height
+        self.frame_rate = frame_rate
+        self.formats = formats
+        self.replay = replay
+        self.cameras = cameras
+
+        # sensor-sized BGR frames, made on first use as it takes a while
+        self.frames = None
+
+    def sensor_frames(self):
+        if self.frames is None:
+            if self.replay:
+                self.frames = load_frames(self.replay,
+                                          self.width, self.height)
+            else:
+                self.frames = generate_frames(self.width, self.height)
+
+        return self.frames
+
+    def BusManager(self):
+        return BusManager(self)
+
+    def Camera(self):
+        return Camera(self)
+
+
+class BusManager:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def getNumOfCameras(self):
+        return self.backend.cameras
+
+    def getCameraFromIndex(self, index):
+        if index >= self.backend.cameras:
+            raise Fc2error('No camera at index %d' % index)
+
+        return index
+
+
+class Camera:
+    """A simulated camera, see Backend."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.guid = None
+
+        self.lock = threading.Lock()
+        self.settings = None
+        self.frames = None
+
+        self.thread = None
+        self.stopping = None
+        self.latest = None
+        self.arrived = threading.Condition(self.lock)
+
+        # frames the callback was too slow to take
+        self.dropped = 0
+
+        # wall clock time at time.monotonic() 0, for camera timestamps
+        self.epoch = time.time() - time.monotonic()
+
+        self.properties = {
+            PROPERTY_TYPE.SHUTTER: Property(PROPERTY_TYPE.SHUTTER, 10.0),
+            PROPERTY_TYPE.GAIN: Property(PROPERTY_TYPE.GAIN, 0.0),
+            PROPERTY_TYPE.FRAME_RATE: Property(PROPERTY_TYPE.FRAME_RATE,
+                                               float(backend.frame_rate)),
+        }
+        self.property_info = {
+            PROPERTY_TYPE.SHUTTER: PropertyInfo(PROPERTY_TYPE.SHUTTER,
+                                                0.01, 1000.0, b'ms'),
+            PROPERTY_TYPE.GAIN: PropertyInfo(PROPERTY_TYPE.GAIN,
+                                             0.0, 24.0, b'dB'),
+            PROPERTY_TYPE.FRAME_RATE: PropertyInfo(PROPERTY_TYPE.FRAME_RATE,
+                                                   1.0, 1000.0, b'fps'),
+        }
+
+    @property
+    def isConnected(self):
+        return self.guid is not None
+
+    def connect(self, guid):
+        self.guid = guid
+        self.setFormat7ConfigurationPacket(
+            0, Format7ImageSettings(MODE.MODE_0, 0, 0,
+                                    self.backend.width, self.backend.height,
+                                    PIXEL_FORMAT.RGB))
+
+    def disconnect(self):
+        self.stopCapture()
+        self.guid = None
+
+    def getFormat7Info(self, mode):
+        return Format7Info(self.backend.width, self.backend.height,
+                           self.backend.formats), True
+
+    def validateFormat7Settings(self, settings):
+        backend = self.backend
+        supported = [getattr(PIXEL_FORMAT, name) for name in backend.formats]
+
+        valid = settings.mode == MODE.MODE_0 and \
+            settings.pixelFormat in supported and \
+            settings.offsetX % offset_step == 0 and \
+            settings.offsetY % offset_step == 0 and \
+            settings.width > 0 and settings.height > 0 and \
+            (settings.width % image_step == 0 or
+             settings.offsetX + settings.width == backend.width) and \
+            (settings.height % image_step == 0 or
+             settings.offsetY + settings.height == backend.height) and \
+            settings.offsetX + settings.width <= backend.width and \
+            settings.offsetY + settings.height <= backend.height
+
+        return Format7PacketInfo(8192), valid
+
+    def setFormat7ConfigurationPacket(self, packetSize, settings):
+        if self.thread is not None:
+            raise Fc2error('Cannot change mode while capturing')
+
+        packet, valid = self.validateFormat7Settings(settings)
+        if not valid:
+            raise Fc2error('Invalid Format7 settings')
+
+        self.settings = settings
+        self.frames = None
+
+    def mode_frames(self):
+        """The sensor frames cropped and converted for the current mode."""
+        if self.frames is None:
+            s = self.settings
+            self.frames = [convert(frame[s.offsetY:s.offsetY + s.height,
+                                         s.offsetX:s.offsetX + s.width],
+                                   s.pixelFormat)
+                           for frame in self.backend.sensor_frames()]
+
+        return self.frames
+
+    def timestamp(self, monotonic):
+        wall = self.epoch + monotonic
+        seconds = int(wall)
+
+        return TimeStamp(seconds, int((wall - seconds) * 1e6))
+
+    def run(self, callback, stopping):
+        frames = self.mode_frames()
+        index = 0
+        next_time = time.monotonic()
+
+        while not stopping.wait(max(0.0, next_time - time.monotonic())):
+            interval = 1.0 / self.properties[PROPERTY_TYPE.FRAME_RATE].absValue
+
+            # frames that came and went while the callback was busy
+            late = int((time.monotonic() - next_time) / interval)
+            if late > 0:
+                self.dropped += late
+                index += late
+                next_time += late * interval
+
+            image = Image(frames[index % len(frames)],
+                          self.timestamp(next_time))
+
+            if callback:
+                try:
+                    callback(image)
+                except Exception:
+                    logging.exception('synthetic: frame callback failed')
+
+            with self.lock:
+                self.latest = image
+                self.arrived.notify_all()
+
+            index += 1
+            next_time += interval
+
+    def startCapture(self, callback=None):
+        if self.thread is not None:
+            raise Fc2error('Isochronous transfer already started')
+
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run,
+                                       args=(callback, self.stopping),
+                                       daemon=True)
+        self.thread.start()
+
+    def stopCapture(self):
+        if self.thread is None:
+            return
+
+        self.stopping.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+        self.latest = None
+
+    def retrieveBuffer(self):
+        """Wait for the next frame, for captures started without a
+        callback.
+        """
+        with self.lock:
+            previous = self.latest
+            while self.latest is previous:
+                if self.thread is None:
+                    raise Fc2error('Isochronous transfer not started')
+                self.arrived.wait(1.0)
+
+            return self.latest
+
+    def getProperty(self, type):
+        if type not in self.properties:
+            raise Fc2error('Property %d not present' % type)
+
+        return self.properties[type]
+
+    def getPropertyInfo(self, type):
+        if type not in self.property_info:
+            return PropertyInfo(type, present=False)
+
+        return self.property_info[type]
+
+    def setProperty(self, type, **kwargs):
+        prop = self.getProperty(type)
+        for name, value in kwargs.items():
+            setattr(prop, name, value)
@@ -0,0 +1,277 @@
+import asyncio
+import struct
+
+import serial
+
+from .port import Port, ReceiveBuffer
+from .recorder import RECEIVED, SENT
+
+class AsyncPort:
+    """A single channel controller driven by an asyncio event loop.
+
+    Unlike Port there is no worker thread: the serial file descriptor is
+    registered with loop.add_reader() and incoming bytes are parsed in the
+    loop, so one loop can drive many controllers. Replies to request() resolve
+    its awaitable, everything else is available from recv() or by iterating:
+
+        port = await AsyncPort.open('/dev/ttyUSB0')
+        info = await port.request(MGMSG_HW_REQ_INFO(), MGMSG_HW_GET_INFO)
+        async for msg in port:
+            ...
+    """
+    #Header of every message, enough to know its length
+    _header = struct.Struct('<HHBB')
+    #Seconds between repeats of MGMSG_HW_REQ_INFO while opening, quiet time
+    #that counts as flushed and the status acknowledgement period, see Port
+    info_retry = Port.info_retry
+    idle_time = Port.idle_time
+    flush_timeout = Port.flush_timeout
+    keepalive_interval = Port.keepalive_interval
+
+    def __init__(self, port, sn = None, loop = None, recorder = None):
+        """Use AsyncPort.open(), which also does the controller handshake."""
+        self._loop = loop or asyncio.get_running_loop()
+        self._port = port
+        self._serial_number = None if sn is None else int(sn)
+        self._info_message = None
+        self._debug = False
+        #A recorder.Recorder logging all traffic, or None
+        self.recorder = recorder
+
+        self._buffer = ReceiveBuffer()
+        self._messages = asyncio.Queue()
+        #Outstanding request() calls, as (expect, chan_ident, future), oldest first
+        self._pending_requests = []
+        #Bytes send() could not write yet, and the futures waiting for them
+        self._write_buffer = bytearray()
+        self._write_waiters = []
+        #loop.time() when data last arrived, and the status acknowledgement timer
+        self._last_received = self._loop.time()
+        self._keepalive_timer = None
+
+        self._serial = serial.Serial(port,
+                                     baudrate=115200,
+                                     bytesize=serial.EIGHTBITS,
+                                     parity=serial.PARITY_NONE,
+                                     stopbits=serial.STOPBITS_ONE,
+                                     rtscts=True,
+                                     timeout=0,
+                                     write_timeout=0)
+        self._loop.add_reader(self._serial.fileno(), self._on_readable)
+
+    @classmethod
+    async def open(cls, port, sn = None, loop = None, timeout = 3, recorder = None):
+        """Open port and identify the controller, see Port.__init__.
+
+        recorder -- a recorder.Recorder to log all traffic to, handshake included
+        """
+        from ..message import MGMSG_HW_NO_FLASH_PROGRAMMING, MGMSG_HW_REQ_INFO, MGMSG_HW_GET_INFO, \
+            MGMSG_HW_START_UPDATEMSGS, MGMSG_HW_STOP_UPDATEMSGS
+
+        self = cls(port, sn, loop, recorder)
+        try:
+            await self.send(MGMSG_HW_NO_FLASH_PROGRAMMING())
+            await self.send(MGMSG_HW_STOP_UPDATEMSGS())
+
+            await self._flush_input()
+
+            #Ask again every info_retry seconds, like Port._request_info()
+            deadline = self._loop.time() + timeout
+            while self._info_message is None:
+                wait = min(self.info_retry, deadline - self._loop.time())
+                if wait <= 0:
+                    raise TimeoutError('No MGMSG_HW_GET_INFO from {0} within {1}s'.format(port, timeout))
+                try:
+                    self._info_message = await self.request(MGMSG_HW_REQ_INFO(), MGMSG_HW_GET_INFO, timeout = wait)
+                except asyncio.TimeoutError:
+                    pass
+            if self._serial_number is None:
+                self._serial_number = self._info_message['serial_number']
+
+            await self.send(MGMSG_HW_START_UPDATEMSGS(update_rate = 1))
+        except:
+            self.close()
+            raise
+
+        self._keepalive_timer = self._loop.call_later(self.keepalive_interval, self._keepalive)
+        return self
+
+    async def _flush_input(self):
+        """Drop whatever arrives until the controller has been quiet for
+        idle_time, like Port._flush_input()."""
+        deadline = self._loop.time() + self.flush_timeout
+        while self._loop.time() < deadline:
+            quiet = self._loop.time() - self._last_received
+            if quiet >= self.idle_time:
+                break
+            await asyncio.sleep(self.idle_time - quiet)
+        self._buffer.clear()
+        while not self._messages.empty():
+            self._messages.get_nowait()
+
+    def close(self):
+        if self._keepalive_timer is not None:
+            self._keepalive_timer.cancel()
+            self._keepalive_timer = None
+        if self._serial.is_open:
+            self._loop.remove_reader(self._serial.fileno())
+            self._loop.remove_writer(self._serial.fileno())
+            self._serial.close()
+        self._fail(ConnectionError('{0!r} closed'.format(self)))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    @property
+    def serial_number(self):
+        return self._serial_number
+
+    @property
+    def channel_count(self):
+        return self._info_message['nchs']
+
+    async def send(self, msg):
+        """Send msg, returning once it has been handed to the serial port."""
+        waiter = self._write(msg)
+        if waiter is not None:
+            await waiter
+
+    def _write(self, msg):
+        """Write msg, or queue it until the port can take it and return a
+        future for that."""
+        msg.source = 0x01
+        msg.dest = 0x50
+        if self._debug:
+            print('> ', msg)
+
+        data = bytes(msg)
+        if self.recorder is not None:
+            self.recorder.record(SENT, data)
+        if not self._write_buffer:
+            data = data[self._serial.write(data):]
+            if not data:
+                return None
+            self._loop.add_writer(self._serial.fileno(), self._on_writable)
+        self._write_buffer += data
+
+        waiter = self._loop.create_future()
+        self._write_waiters.append(waiter)
+        return waiter
+
+    async def request(self, msg, expect, chan_ident = None, timeout = None):
+        """Send msg and return the first reply that is an instance of expect,
+        see Port.request(). Raises asyncio.TimeoutError after timeout seconds.
+        """
+        if chan_ident is None and 'chan_ident' in msg:
+            chan_ident = msg['chan_ident']
+
+        future = self._loop.create_future()
+        entry = (expect, chan_ident, future)
+        self._pending_requests.append(entry)
+        try:
+            await self.send(msg)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if entry in self._pending_requests:
+                self._pending_requests.remove(entry)
+
+    async def recv(self):
+        """Return the next message that no request() was waiting for."""
+        return await self._messages.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.recv()
+
+    def _on_writable(self):
+        try:
+            written = self._serial.write(bytes(self._write_buffer))
+        except serial.SerialException as e:
+            self._fail(e)
+            return
+        del self._write_buffer[:written]
+
+        if not self._write_buffer:
+            self._loop.remove_writer(self._serial.fileno())
+            waiters, self._write_waiters = self._write_waiters, []
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    def _on_readable(self):
+        try:
+            data = self._serial.read(max(1, self._serial.in_waiting))
+        except serial.SerialException:
+            self.close()
+            return
+        self._last_received = self._loop.time()
+        self._buffer.append(data)
+
+        for msg in self._parse():
+            if self._debug:
+                print('< ', msg)
+            if not self._resolve_request(msg):
+                self._messages.put_nowait(msg)
+
+    def _parse(self):
+        from ..message import Message
+        messages = []
+        while len(self._buffer) >= self._header.size:
+            with self._buffer.view() as view:
+                message_id, length, dest, source = self._header.unpack_from(view)
+                size = self._header.size + (length if dest & 0x80 else 0)
+                if len(view) < size:
+                    break
+                if self.recorder is not None:
+                    self.recorder.record(RECEIVED, view[:size].tobytes())
+                try:
+                    messages.append(Message.parse(view))
+                except (KeyError, AssertionError):
+                    print("Ignoring message", hex(message_id))
+            self._buffer.consume(size)
+        return messages
+
+    def _keepalive(self):
+        #The controller stops sending status updates unless they are acknowledged, see Port._keepalive()
+        from ..message import MGMSG_MOT_ACK_DCSTATUSUPDATE
+        try:
+            waiter = self._write(MGMSG_MOT_ACK_DCSTATUSUPDATE())
+        except serial.SerialException:
+            self.close()
+            return
+        if waiter is not None:
+            #Nobody awaits it, a failure is handled by close() and _fail()
+            waiter.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._keepalive_timer = self._loop.call_later(self.keepalive_interval, self._keepalive)
+
+    def _resolve_request(self, msg):
+        msg_chan_ident = msg['chan_ident'] if 'chan_ident' in msg else None
+        for entry in self._pending_requests:
+            expect, chan_ident, future = entry
+            if future.done() or not isinstance(msg, expect):
+                continue
+            if chan_ident is not None and msg_chan_ident is not None and chan_ident != msg_chan_ident:
+                continue
+
+            self._pending_requests.remove(entry)
+            future.set_result(msg)
+            return True
+        return False
+
+    def _fail(self, exception):
+        pending, self._pending_requests = self._pending_requests, []
+        waiters, self._write_waiters = self._write_waiters, []
+        for expect, chan_ident, future in pending:
+            if not future.done():
+                future.set_exception(exception)
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_exception(exception)
+
+    def __repr__(self):
+        return '{0}({1!r},{2!r})'.format(self.__class__.__name__, self._port, self._serial_number)
@@ -1,38 +1,112 @@
-def discover_stages():
-    import usb
-    import os
-    from .port import Port
+import concurrent.futures
+import json
+import os
+
+#USB vendor id of the FTDI serial converters in Thorlabs controllers
+ftdi_vendor_id = 0x0403
+
+#Where the serial number -> port mapping of the last discovery is kept
+cache_path = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'thorpy', 'ports.json')
+
+def list_ftdi_ports():
+    """Return {serial number: port} of every FTDI serial converter.
+
+    Only the metadata serial.tools.list_ports reads from sysfs (or the
+    platform's equivalent) is used, no device is opened.
+    """
     from serial.tools.list_ports import comports
-    import platform
-    
-    serial_ports = [(x[0], x[1], dict(y.split('=', 1) for y in x[2].split(' ') if '=' in y)) for x in comports()]
-    
-    for dev in usb.core.find(find_all=True, custom_match= lambda x: x.bDeviceClass != 9):
-        try:
-            #FIXME: this avoids an error related to https://github.com/walac/pyusb/issues/139
-            #FIXME: this could maybe be solved in a better way?
-            dev._langids = (1033, )
-            if dev.manufacturer != 'FTDI':
+    return {info.serial_number: info.device for info in comports()
+            if info.vid == ftdi_vendor_id and info.serial_number}
+
+def _port_serial_number(port):
+    """The serial number of the USB device behind port, None if it is gone."""
+    if not os.path.exists(port):
+        return None
+    try:
+        from serial.tools.list_ports_linux import SysFS
+    except ImportError:
+        #Not Linux, look it up among all ports
+        return {port: sn for sn, port in list_ftdi_ports().items()}.get(port)
+    info = SysFS(port)
+    if info.vid != ftdi_vendor_id:
+        return None
+    return info.serial_number
+
+def load_cache(path = None):
+    """Return the cached {serial number: port} pairs that are still valid,
+    those whose port still belongs to the same device."""
+    try:
+        with open(path or cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    return {sn: port for sn, port in cache.items() if _port_serial_number(port) == sn}
+
+def save_cache(ports, path = None):
+    path = path or cache_path
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(ports, f)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        pass  #Only makes the next discovery slower
+
+def _open_ports(ports, recorder = None):
+    """Port.create() each of the (port, serial number) pairs at the same time,
+    yielding the ports as they open. Ports that fail to open are reported and
+    skipped, so one bad controller doesn't hide the others."""
+    from .port import Port
+    ports = list(ports)
+    if not ports:
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(len(ports)) as executor:
+        futures = {executor.submit(Port.create, port, sn, recorder): port for port, sn in ports}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                p = future.result()
+            except Exception as e:
+                print("Unable to open", futures[future], repr(e))
                 continue
-        except usb.core.USBError:
-            continue
-        
-        if platform.system() == 'Linux':
-            port_candidates = [x[0] for x in serial_ports if x[2].get('SER', None) == dev.serial_number]
-        else:
-            raise NotImplementedError("Implement for platform.system()=={0}".format(platform.system()))
-        
-        assert len(port_candidates) == 1
-        
-        port = port_candidates[0]
-
-        p = Port.create(port, dev.serial_number)
+            yield p
+
+def discover_stages(ports = None, use_cache = True, recorder = None):
+    """Yield the stages of every controller found.
+
+    ports -- (port, serial number) pairs to open instead of enumerating FTDI
+             USB devices, e.g. [(controller.port, controller.serial_number)]
+             for a virtual.VirtualController
+    use_cache -- open the controllers found last time first, before looking
+                 for others (see cache_path)
+    recorder -- a recorder.Recorder to log the traffic of every controller
+                opened to, from the handshake on
+
+    Controllers are opened in parallel, the cached ones in one go and then
+    the remaining ones in another. Those that can't be opened are skipped.
+    """
+    if ports is not None:
+        for p in _open_ports(((port, str(sn)) for port, sn in ports), recorder):
+            for stage in p.get_stages().values():
+                yield stage
+        return
+
+    cached = load_cache() if use_cache else {}
+    for p in _open_ports(((port, sn) for sn, port in cached.items()), recorder):
         for stage in p.get_stages().values():
             yield stage
-        
+
+    found = list_ftdi_ports()
+    save_cache(found)
+    for p in _open_ports(((port, sn) for sn, port in found.items() if sn not in cached), recorder):
+        for stage in p.get_stages().values():
+            yield stage
+
 if __name__ == '__main__':
-    print(list(discover()))
-    
+    print(list(discover_stages()))
+
 
 #iManufacturer           1 Thorlabs
 #    iProduct                2 APT DC Motor Controller
@@ -1,124 +1,313 @@
 import serial
 import select
+import struct
 import threading
+import concurrent.futures
+from .reactor import Reactor
+from .recorder import RECEIVED, SENT
 import time
 import queue
 import weakref
 
+class ReceiveBuffer:
+    """Bytes received but not parsed yet.
+
+    A preallocated bytearray with read and write cursors. Parsed messages only
+    move the read cursor, unread bytes are moved to the front when the space
+    after the write cursor runs out, and the array grows if they still don't
+    fit. view() gives a memoryview of the unread bytes, release it before the
+    next append().
+    """
+    def __init__(self, size = 4096):
+        self._data = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def append(self, data):
+        n = len(data)
+        if self._end + n > len(self._data):
+            self._compact(n)
+        self._data[self._end:self._end + n] = data
+        self._end += n
+
+    def _compact(self, space):
+        unread = self._end - self._start
+        if unread:
+            self._data[:unread] = self._data[self._start:self._end]
+        self._start, self._end = 0, unread
+
+        if unread + space > len(self._data):
+            self._data.extend(bytes(max(unread + space, 2 * len(self._data)) - len(self._data)))
+
+    def view(self):
+        return memoryview(self._data)[self._start:self._end]
+
+    def consume(self, n):
+        self._start += n
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def clear(self):
+        self._start = self._end = 0
+
 class Port:
     #List to make "quasi-singletons"
     static_port_list = weakref.WeakValueDictionary()
     static_port_list_lock = threading.RLock()
-
-    def __init__(self, port, sn):
+    #One lock per port being opened, so different ports can be opened at the same time
+    static_port_open_locks = {}
+
+    #Seconds without data after which the input is considered flushed
+    idle_time = 0.02
+    #Give up flushing a controller that keeps talking after this many seconds
+    flush_timeout = 0.5
+    #Seconds to wait for MGMSG_HW_GET_INFO, and between repeats of the request
+    info_timeout = 3
+    info_retry = 0.2
+    #Header of every message, enough to know its length
+    _header = struct.Struct('<HHBB')
+
+    def __init__(self, port, sn, recorder = None):
         super().__init__()
+        self._port = port
+        #Until the controller has told us
+        self._serial_number = None
+        self._debug = False
+        #A recorder.Recorder logging all traffic, or None. Set before the handshake so it is logged too
+        self.recorder = recorder
         self._lock = threading.RLock()
         self._lock.acquire()
-        self._buffer = b''
+        self._buffer = ReceiveBuffer()
         self._unhandled_messages = queue.Queue()
+        #Outstanding request() calls, as (expect, chan_ident, future), oldest first
+        self._pending_requests = []
+        self._pending_requests_lock = threading.Lock()
         self._serial = serial.Serial(port,
                                      baudrate=115200,
                                      bytesize=serial.EIGHTBITS,
                                      parity=serial.PARITY_NONE,
                                      stopbits=serial.STOPBITS_ONE,
-                                     rtscts=True)
-
-        # The Thorlabs protocol description recommends toggeling the RTS pin and resetting the
-        # input and output buffer. This makes sense, since the internal controller of the Thorlabs
-        # device does not know what data has reached us of the FTDI RS232 converter.
-        # Similarly, we do not know the state of the controller input buffer.
-        # Be toggling the RTS pin, we let the controller know that it should flush its caches.
-        self._serial.setRTS(1)
-        time.sleep(0.05)
-        self._serial.reset_input_buffer()
-        self._serial.reset_output_buffer()
-        time.sleep(0.05)
-        self._serial.setRTS(0)
+                                     rtscts=True,
+                                     timeout=self.idle_time)
 
-        self._port = port
-        self._debug = False
-
-        from ..message import MGMSG_HW_NO_FLASH_PROGRAMMING, MGMSG_HW_REQ_INFO, MGMSG_HW_START_UPDATEMSGS, MGMSG_HW_STOP_UPDATEMSGS
-        self.send_message(MGMSG_HW_NO_FLASH_PROGRAMMING(source = 0x01, dest = 0x50))
+        #Don't leave the port open or the lock held if the controller doesn't answer
+        try:
+            # The Thorlabs protocol description recommends toggeling the RTS pin and resetting the
+            # input and output buffer. This makes sense, since the internal controller of the Thorlabs
+            # device does not know what data has reached us of the FTDI RS232 converter.
+            # Similarly, we do not know the state of the controller input buffer.
+            # Be toggling the RTS pin, we let the controller know that it should flush its caches.
+            # A pseudo-terminal, such as a virtual.VirtualController, has no RTS pin to toggle.
+            try:
+                self._serial.setRTS(1)
+            except OSError:
+                pass
+            time.sleep(0.05)
+            self._serial.reset_input_buffer()
+            self._serial.reset_output_buffer()
+            try:
+                self._serial.setRTS(0)
+            except OSError:
+                pass
 
-        # Now that the input buffer of the device is flushed, we can tell it to stop reporting updates and
-        # then flush away any remaining messages.
-        self.send_message(MGMSG_HW_STOP_UPDATEMSGS())
-        time.sleep(0.5)
-        self._serial.reset_input_buffer()
+            from ..message import MGMSG_HW_NO_FLASH_PROGRAMMING, MGMSG_HW_REQ_INFO, MGMSG_HW_START_UPDATEMSGS, MGMSG_HW_STOP_UPDATEMSGS
+            self.send_message(MGMSG_HW_NO_FLASH_PROGRAMMING(source = 0x01, dest = 0x50))
 
-        self._info_message = None
-        while self._info_message is None:
-            self.send_message(MGMSG_HW_REQ_INFO())
-            try:
-                self._info_message = self._recv_message(blocking = True)
-            except: # TODO: Be more specific on what we catch here
-                self._buffer = b''
-                self._serial.flushInput()
+            # Now that the input buffer of the device is flushed, we can tell it to stop reporting updates and
+            # then flush away any remaining messages.
+            self.send_message(MGMSG_HW_STOP_UPDATEMSGS())
+            self._flush_input()
 
-        self._serial_number = int(sn)
-        if self._serial_number is None:
-            self._serial_number = self._info_message['serial_number']
+            self._info_message = self._request_info()
 
-        time.sleep(1)
+            if sn is None:
+                self._serial_number = self._info_message['serial_number']
+            else:
+                self._serial_number = int(sn)
 
-        self.send_message(MGMSG_HW_START_UPDATEMSGS(update_rate = 1))
+            self.send_message(MGMSG_HW_START_UPDATEMSGS(update_rate = 1))
+        except:
+            self._lock.release()
+            self._serial.close()
+            raise
 
         self._stages = weakref.WeakValueDictionary()
 
         self._lock.release()
-        self.daemon = False
         print("Constructed: {0!r}".format(self))
 
-        self._thread_main = threading.current_thread()
-        self._thread_worker_initialized = threading.Event()
-        self._thread_worker = threading.Thread(target = Port.run, args = (weakref.proxy(self), ))
-        self._thread_worker.start()
-
-        self._thread_worker_initialized.wait()
-
+        #The shared reactor thread reads from us from now on, and keeps status updates flowing
+        self._fileno = self._serial.fileno()
+        self._reactor = Reactor.instance()
+        self._reactor.register(self)
+        #Through a weak reference, the timer must not keep us alive
+        keepalive = weakref.WeakMethod(self._keepalive)
+        self._keepalive_timer = self._reactor.call_every(self.keepalive_interval, lambda: keepalive()())
+
+
+    def _flush_input(self):
+        """Discard input until the controller has been quiet for idle_time."""
+        deadline = time.monotonic() + self.flush_timeout
+        while time.monotonic() < deadline:
+            #Reads time out after idle_time
+            if not self._serial.read(max(1, self._serial.in_waiting)):
+                break
+        self._buffer.clear()
+
+    def _request_info(self):
+        """Ask for MGMSG_HW_GET_INFO until it arrives, raising TimeoutError after info_timeout."""
+        from ..message import MGMSG_HW_REQ_INFO, MGMSG_HW_GET_INFO
+        deadline = time.monotonic() + self.info_timeout
+        while time.monotonic() < deadline:
+            self.send_message(MGMSG_HW_REQ_INFO())
+            retry_time = min(time.monotonic() + self.info_retry, deadline)
+            while time.monotonic() < retry_time:
+                try:
+                    msg = self._recv_message(blocking = True, timeout = retry_time - time.monotonic())
+                except AssertionError:
+                    #Not from the controller we expect, start from a clean slate
+                    self._flush_input()
+                    break
+                if isinstance(msg, MGMSG_HW_GET_INFO):
+                    return msg
+        raise TimeoutError('No MGMSG_HW_GET_INFO from {0} within {1}s'.format(self._port, self.info_timeout))
 
     def __del__(self):
         print("Destructed: {0!r}".format(self))
-        # self._thread_worker.join()
+        if hasattr(self, '_reactor'):
+            self._keepalive_timer.cancel()
+            self._reactor.unregister(self._fileno, self._serial.close)
+            self._fail_requests(ConnectionError('{0!r} closed'.format(self)))
 
     def send_message(self, msg):
         with self._lock:
             if self._debug:
                 print('> ', msg)
-            self._serial.write(bytes(msg))
+            data = bytes(msg)
+            if self.recorder is not None:
+                self.recorder.record(SENT, data)
+            self._serial.write(data)
 
-    @staticmethod
-    def run(self):
-        try:
-            self._continue = True
-            timeout = 1
-            self._thread_worker_initialized.set()
+    #Seconds between MGMSG_MOT_ACK_DCSTATUSUPDATE, without them the controller stops sending status updates
+    keepalive_interval = 0.5
 
-            while self._thread_main.is_alive():
-                #Trick to avoid holding lock
-                r, w, e = select.select([self._serial], [], [], timeout)
+    def _keepalive(self):
+        from ..message import MGMSG_MOT_ACK_DCSTATUSUPDATE
+        try:
+            self.send_message(MGMSG_MOT_ACK_DCSTATUSUPDATE())
+        except (serial.SerialException, OSError) as e:
+            self._connection_lost(e)
+
+    def _connection_lost(self, exception):
+        """Stop using a port that failed, e.g. a controller that was unplugged.
+
+        Runs on the reactor thread. The port stays readable once it has
+        failed, so it must be unregistered or the reactor would spin on it.
+        """
+        if self._keepalive_timer.cancelled:
+            return
+        print("Lost {0!r}: {1}".format(self, exception))
+        self._keepalive_timer.cancel()
+        self._reactor.unregister(self._fileno, self._serial.close)
+        self._fail_requests(ConnectionError('{0!r} lost: {1}'.format(self, exception)))
+
+    def _on_readable(self):
+        """Called by the reactor thread when data has arrived."""
+        #One read may bring in several messages, handle them all
+        while True:
+            try:
                 msg = self._recv_message(False)
-                if msg is not None:
-                    message_handled = self._handle_message(msg)
-                    if not message_handled:
-                        print("Unhandled message", msg)
-                        self._unhandled_messages.put(msg)
-
-            self._serial.close()
-        except ReferenceError:
-            pass  #Object deleted
-
+            except AssertionError:
+                #Not addressed to us, it has been consumed, carry on with the rest
+                print("Ignoring misaddressed message")
+                continue
+            except (serial.SerialException, OSError) as e:
+                self._connection_lost(e)
+                return
+            if msg is None:
+                break
+            message_requested = self._resolve_requests(msg)
+            message_handled = self._handle_message(msg)
+            if not message_handled and not message_requested:
+                print("Unhandled message", msg)
+                self._unhandled_messages.put(msg)
+
+    def request(self, msg, expect, chan_ident = None):
+        """Send msg and return a concurrent.futures.Future of the reply.
+
+        The future is resolved by the worker thread with the first message
+        that is an instance of expect (a message class or tuple of them) and,
+        for channel messages, is for chan_ident. chan_ident defaults to the
+        one in msg. Several requests may be in flight at once, each reply
+        resolves the oldest matching one. Cancel the future to give up on it.
+        """
+        if chan_ident is None and 'chan_ident' in msg:
+            chan_ident = msg['chan_ident']
+
+        future = concurrent.futures.Future()
+        entry = (expect, chan_ident, future)
+        with self._pending_requests_lock:
+            self._pending_requests.append(entry)
+        try:
+            self.send_message(msg)
+        except Exception as e:
+            with self._pending_requests_lock:
+                self._pending_requests.remove(entry)
+            future.set_exception(e)
+        return future
+
+    async def request_async(self, msg, expect, chan_ident = None):
+        """Like request(), but awaitable from an asyncio event loop."""
+        import asyncio
+        return await asyncio.wrap_future(self.request(msg, expect, chan_ident))
+
+    def _resolve_requests(self, msg):
+        """Hand msg to the oldest request waiting for it, return whether one was."""
+        with self._pending_requests_lock:
+            if not self._pending_requests:
+                return False
 
-    def _recv(self, l = 1, blocking = False):
+            msg_chan_ident = msg['chan_ident'] if 'chan_ident' in msg else None
+            for entry in list(self._pending_requests):
+                expect, chan_ident, future = entry
+                if future.cancelled():
+                    self._pending_requests.remove(entry)
+                    continue
+                if not isinstance(msg, expect):
+                    continue
+                if chan_ident is not None and msg_chan_ident is not None and chan_ident != msg_chan_ident:
+                    continue
+
+                self._pending_requests.remove(entry)
+                if future.set_running_or_notify_cancel():
+                    future.set_result(msg)
+                    return True
+            return False
+
+    def _fail_requests(self, exception):
+        with self._pending_requests_lock:
+            pending, self._pending_requests = self._pending_requests, []
+        for expect, chan_ident, future in pending:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(exception)
+
+
+    def _recv(self, l = None, blocking = False):
+        """Read l bytes into the buffer, by default everything that has arrived
+        (at least one byte when blocking)."""
         with self._lock:
             if not blocking:
                 r, w, e = select.select([self._serial], [], [], 0)
                 if len(r) == 0:
                     return 0
 
+            if l is None:
+                l = max(1, self._serial.in_waiting)
             new_data = self._serial.read(l)
-            self._buffer += new_data
+            self._buffer.append(new_data)
             return len(new_data)
 
 
@@ -134,26 +323,41 @@ class Port:
 
     def _recv_message(self, blocking = False, timeout = None):
         with self._lock:
-            from ..message import Message, IncompleteMessageException
+            from ..message import Message
             msg = None
             start_time = time.time()
             while msg is None:
-                try:
-                    msg = Message.parse(self._buffer)
-                except IncompleteMessageException:
-                    msg = None
-                    length = self._recv(blocking = blocking)
-
-                    #We were not able to read data
-                    if length == 0 and not blocking:
-                        return None
-
-                    #Passed timeout...
-                    if blocking and timeout is not None and start_time < time.time() - timeout:
-                        return None
-
-
-            self._buffer = self._buffer[len(msg):]
+                #The header tells the length, so even messages we can't parse can be skipped
+                size = None
+                with self._buffer.view() as view:
+                    if len(view) >= self._header.size:
+                        message_id, length, dest, source = self._header.unpack_from(view)
+                        size = self._header.size + (length if dest & 0x80 else 0)
+                        if len(view) < size:
+                            size = None
+                    if size is not None:
+                        #Record the raw bytes, even of messages that don't parse
+                        if self.recorder is not None:
+                            self.recorder.record(RECEIVED, view[:size].tobytes())
+                        try:
+                            msg = Message.parse(view)
+                        except (KeyError, AssertionError):
+                            #Unknown id or garbled
+                            print("Ignoring message", hex(message_id))
+
+                if size is not None:
+                    self._buffer.consume(size)
+                    continue
+
+                length = self._recv(blocking = blocking)
+
+                #We were not able to read data
+                if length == 0 and not blocking:
+                    return None
+
+                #Passed timeout...
+                if blocking and timeout is not None and start_time < time.time() - timeout:
+                    return None
 
             if self._debug:
                 print('< ', msg)
@@ -178,28 +382,58 @@ class Port:
         return {}
 
     @classmethod
-    def create(cls, port, sn):
+    def create(cls, port, sn, recorder = None):
+        """Return the open Port for port, opening it if need be.
+
+        recorder -- a recorder.Recorder to log the port's traffic to, from the
+                    handshake on when the port is opened here
+        """
         with Port.static_port_list_lock:
             try:
-                return Port.static_port_list[port]
+                p = Port.static_port_list[port]
             except KeyError:
+                open_lock = Port.static_port_open_locks.setdefault(port, threading.Lock())
+            else:
+                if recorder is not None:
+                    p.recorder = recorder
+                return p
+
+        #Open outside of static_port_list_lock, so other ports can be opened meanwhile
+        with open_lock:
+            try:
+                with Port.static_port_list_lock:
+                    try:
+                        p = Port.static_port_list[port]
+                    except KeyError:
+                        pass
+                    else:
+                        if recorder is not None:
+                            p.recorder = recorder
+                        return p
+
                 #Do we have a BSC103 or BBD10x? These are card slot controllers
                 if sn[:2] in ('70', '73', '94'):
-                    p = CardSlotPort(port, sn)
+                    p = CardSlotPort(port, sn, recorder)
                 else:
-                    p = SingleControllerPort(port, sn)
+                    p = SingleControllerPort(port, sn, recorder)
 
-                Port.static_port_list[port] = p
+                with Port.static_port_list_lock:
+                    Port.static_port_list[port] = p
 
                 return p
+            finally:
+                #Opened or failed, either way the lock is not needed any more
+                with Port.static_port_list_lock:
+                    if Port.static_port_open_locks.get(port) is open_lock:
+                        del Port.static_port_open_locks[port]
 
 class CardSlotPort(Port):
-    def __init__(self, port, sn = None):
+    def __init__(self, port, sn = None, recorder = None):
         raise NotImplementedError("Card slot ports are not supported yet")
 
 class SingleControllerPort(Port):
-    def __init__(self, port, sn = None):
-        super().__init__(port, sn)
+    def __init__(self, port, sn = None, recorder = None):
+        super().__init__(port, sn, recorder)
 
         if self.channel_count != 1:
             raise NotImplementedError("Multiple channel devices are not supported yet")
@@ -210,8 +444,8 @@ class SingleControllerPort(Port):
         msg.dest = 0x50
         super().send_message(msg)
 
-    def _recv_message(self, blocking = False):
-        msg = super()._recv_message(blocking)
+    def _recv_message(self, blocking = False, timeout = None):
+        msg = super()._recv_message(blocking, timeout)
         if msg is None:
             return msg
 
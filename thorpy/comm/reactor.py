@@ -0,0 +1,173 @@
+import heapq
+import itertools
+import os
+import selectors
+import threading
+import time
+import traceback
+
+class Timer:
+    """A callback scheduled with Reactor.call_later() or call_every()."""
+    def __init__(self, deadline, interval, callback):
+        self._deadline = deadline
+        self._interval = interval
+        self._callback = callback
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+class Reactor:
+    """One thread doing the I/O of every open Port.
+
+    A selectors.DefaultSelector waits on the file descriptor of every
+    registered port and calls its _on_readable() when data arrives, and
+    timers (keepalives, position streams) run on the same thread, so adding
+    controllers adds neither threads nor wakeups. Use Reactor.instance().
+
+    Like Port's worker thread used to, the thread runs until the main thread
+    exits and then closes the ports that are still open.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None or not cls._instance._thread.is_alive():
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._calls = []           # functions to run on the reactor thread
+        self._timers = []          # heap of (deadline, sequence, Timer)
+        self._sequence = itertools.count()
+
+        #Writing to the pipe wakes the selector up to pick up calls and timers
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        os.set_blocking(self._wakeup_write, False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+
+        self._thread_main = threading.main_thread()
+        self._thread = threading.Thread(target = self.run, name = 'thorpy reactor')
+        self._thread.start()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_write, b'\0')
+        except OSError:
+            pass  #Already woken, or shut down
+
+    def call_soon(self, callback):
+        """Run callback on the reactor thread."""
+        with self._lock:
+            self._calls.append(callback)
+        self._wakeup()
+
+    def register(self, port):
+        """Dispatch data arriving on port to port._on_readable()."""
+        import weakref
+        fileno = port.fileno()
+        ref = weakref.ref(port)
+        def register():
+            if fileno in self._selector.get_map():
+                #Left over from a port that was closed without unregistering
+                self._selector.unregister(fileno)
+            self._selector.register(fileno, selectors.EVENT_READ, ref)
+        self.call_soon(register)
+
+    def unregister(self, fileno, then = None):
+        """Stop watching fileno, then call then() on the reactor thread."""
+        def unregister():
+            try:
+                self._selector.unregister(fileno)
+            except (KeyError, ValueError):
+                pass
+            if then is not None:
+                then()
+        self.call_soon(unregister)
+
+    def call_later(self, delay, callback):
+        return self._schedule(Timer(time.monotonic() + delay, None, callback))
+
+    def call_every(self, interval, callback):
+        """Call callback every interval seconds, until the Timer is cancelled."""
+        return self._schedule(Timer(time.monotonic() + interval, interval, callback))
+
+    def _schedule(self, timer):
+        with self._lock:
+            heapq.heappush(self._timers, (timer._deadline, next(self._sequence), timer))
+        self._wakeup()
+        return timer
+
+    def _run_calls(self):
+        with self._lock:
+            calls, self._calls = self._calls, []
+        for callback in calls:
+            self._call(callback)
+
+    def _run_timers(self):
+        """Run the timers that are due, return seconds until the next one."""
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            while self._timers and (self._timers[0][0] <= now or self._timers[0][2]._cancelled):
+                deadline, sequence, timer = heapq.heappop(self._timers)
+                if timer._cancelled:
+                    continue
+                due.append(timer)
+                if timer._interval is not None:
+                    #Keep the period, but never queue up missed calls
+                    timer._deadline = max(deadline + timer._interval, now)
+                    heapq.heappush(self._timers, (timer._deadline, next(self._sequence), timer))
+            next_deadline = self._timers[0][0] if self._timers else None
+
+        for timer in due:
+            if not timer._cancelled:
+                self._call(timer._callback)
+
+        return None if next_deadline is None else max(0, next_deadline - now)
+
+    def _call(self, callback):
+        try:
+            callback()
+        except Exception:
+            traceback.print_exc()
+
+    def run(self):
+        while self._thread_main.is_alive():
+            self._run_calls()
+            timeout = self._run_timers()
+            #Check on the main thread at least once a second
+            timeout = 1 if timeout is None else min(timeout, 1)
+
+            for key, events in self._selector.select(timeout):
+                if key.fileobj == self._wakeup_read:
+                    try:
+                        while os.read(self._wakeup_read, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+
+                port = key.data()
+                if port is None:
+                    #Port deleted, its __del__ will unregister it
+                    continue
+                self._call(port._on_readable)
+                del port
+
+        for key in list(self._selector.get_map().values()):
+            port = key.data() if key.data is not None else None
+            if port is not None:
+                port._serial.close()
+        self._selector.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
@@ -0,0 +1,145 @@
+import atexit
+import collections
+import struct
+import threading
+import time
+
+#Directions of a record
+RECEIVED = 0
+SENT = 1
+
+#Start of every log file
+magic = b'APTLOG1\n'
+
+#Before the raw bytes of each message: time.monotonic_ns(), direction, length
+record_header = struct.Struct('<qBH')
+
+class Recorder:
+    """Append every message a port sends or receives to a binary log.
+
+    Pass it to discover_stages(), Port.create() or AsyncPort.open() to log
+    from the handshake on, or set port.recorder later. One recorder may serve
+    several ports. record() only timestamps the bytes and queues them, a
+    background thread writes them out every flush_interval seconds. Times are
+    time.monotonic_ns(), the clock of camera.Frame.host_time (in seconds).
+    Read the log back with load().
+    """
+    def __init__(self, path, flush_interval = 0.5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.count = 0
+
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(magic)
+
+        #deque.append() and popleft() are thread safe, record() needs no lock
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target = self._run, name = 'thorpy recorder', daemon = True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, direction, data):
+        self._pending.append((time.monotonic_ns(), direction, data))
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            #Drain rather than swap the deque, a record() racing with a swap
+            #could append to the old one after it was written
+            pending = []
+            try:
+                while True:
+                    pending.append(self._pending.popleft())
+            except IndexError:
+                pass
+            if pending:
+                pack = record_header.pack
+                self._file.write(b''.join(pack(t, direction, len(data)) + data for t, direction, data in pending))
+                self._file.flush()
+                self.count += len(pending)
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+        with self._lock:
+            self._file.close()
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read(path):
+    """Yield (monotonic_ns, direction, raw bytes) for each record in a log."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(magic):
+        raise ValueError('{0} is not an APT log'.format(path))
+
+    offset = len(magic)
+    while offset + record_header.size <= len(data):
+        t, direction, length = record_header.unpack_from(data, offset)
+        offset += record_header.size
+        if offset + length > len(data):
+            break  #Cut off mid record
+        yield t, direction, data[offset:offset + length]
+        offset += length
+
+def load(path):
+    """Decode a log into a numpy structured array, one row per message.
+
+    Every row has the fields time (seconds, like time.monotonic()),
+    direction, message_id, name, dest and source, plus one int64 field for
+    each numeric parameter of the message classes in the log, 0 where a
+    message has no such parameter. Messages the registry does not know keep
+    their message_id, with an empty name.
+    """
+    import numpy
+    from ..message import Message
+
+    fields = [('time', '<f8'),
+              ('direction', 'u1'),
+              ('message_id', '<u2'),
+              ('name', 'U40'),
+              ('dest', 'u1'),
+              ('source', 'u1')]
+
+    records = []
+    parameters = []
+    for t, direction, data in read(path):
+        try:
+            msg = Message.parse(data)
+        except (KeyError, AssertionError):
+            msg = None
+        records.append((t, direction, data, msg))
+        if msg is not None:
+            for name, encoding in msg.parameters:
+                if name is not None and not encoding.endswith('s') and name not in parameters \
+                   and name not in dict(fields):
+                    parameters.append(name)
+
+    dtype = numpy.dtype(fields + [(name, '<i8') for name in parameters])
+
+    result = numpy.zeros(len(records), dtype)
+    for row, (t, direction, data, msg) in zip(result, records):
+        row['time'] = t / 1e9
+        row['direction'] = direction
+        row['message_id'] = struct.unpack_from('<H', data)[0] if len(data) >= 2 else 0
+        if msg is not None:
+            row['name'] = msg.name
+            row['dest'] = msg.dest
+            row['source'] = msg.source
+            for name, value in msg.parameter_items:
+                if name in parameters:
+                    row[name] = value
+    return result
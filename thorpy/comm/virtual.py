@@ -0,0 +1,338 @@
+import os
+import select
+import struct
+import threading
+import time
+import tty
+
+class VirtualController:
+    """A simulated single channel DC servo controller (a TDC001 driving a
+    PRM1-Z8 rotation stage) speaking the APT protocol on a pseudo-terminal.
+
+    It answers MGMSG_HW_REQ_INFO, streams MGMSG_MOT_GET_DCSTATUSUPDATE at
+    update_rate while update messages are enabled and answers status and
+    parameter requests. Moves follow a trapezoidal profile using the velocity
+    and acceleration from MGMSG_MOT_SET_VELPARAMS, and end with
+    MGMSG_MOT_MOVE_COMPLETED, MGMSG_MOT_MOVE_STOPPED or MGMSG_MOT_MOVE_HOMED.
+
+    Open it like a real controller, for example with
+    discover_stages(ports = [(controller.port, controller.serial_number)]).
+    """
+    #Time unit of the velocity and acceleration parameters, see GenericStage._T
+    _T = 2048 / 6e6
+
+    #Integration step of the motion model
+    _step = 0.001
+
+    def __init__(self, serial_number = 83000001, stage_type = 0x06, update_rate = 10,
+                 velocity = 20000, acceleration = 20000, latency = 0):
+        """serial_number -- the first two digits pick the controller type
+        stage_type -- the stage code reported in MGMSG_HW_GET_INFO, 0x06 is a PRM1-Z8
+        update_rate -- status updates per second while updates are enabled
+        velocity, acceleration -- initial limits, in encoder counts/s and counts/s²
+        latency -- seconds to wait before answering each message, to model USB latency
+        """
+        self.serial_number = serial_number
+        self.stage_type = stage_type
+        self.update_rate = update_rate
+        self.latency = latency
+
+        self._lock = threading.Lock()
+
+        #Motion state, in encoder counts
+        self._position = 0.0
+        self._velocity = 0.0
+        self._min_velocity = 0.0
+        self._max_velocity = float(velocity)
+        self._acceleration = float(acceleration)
+        self._target = None
+        self._direction = 0
+        self._homing = False
+        self._homed = False
+        self._enabled = False
+        self._time = time.monotonic()
+
+        self._home_params = dict(home_direction = 2, limit_switch = 1, home_velocity = 0, offset_distance = 0)
+
+        self._updates = False
+        self._next_update = 0
+
+        #Statistics
+        self.received = 0
+        self.sent = 0
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self._buffer = bytearray()
+
+        self._running = True
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return '{0}({1!r},{2!r})'.format(self.__class__.__name__, self.port, self.serial_number)
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _run(self):
+        while self._running:
+            now = time.monotonic()
+            timeout = 0.1
+            if self._target is not None or self._direction or self._velocity:
+                timeout = 0.005
+            if self._updates:
+                timeout = max(0, min(timeout, self._next_update - now))
+
+            r, w, e = select.select([self._master], [], [], timeout)
+            if r:
+                try:
+                    self._buffer += os.read(self._master, 4096)
+                except OSError:
+                    #The host closed its end
+                    continue
+
+                for msg in self._parse():
+                    self.received += 1
+                    if self.latency:
+                        time.sleep(self.latency)
+                    self._handle(msg)
+
+            now = time.monotonic()
+            self._advance(now)
+
+            if self._updates and now >= self._next_update:
+                self._send_status()
+                self._next_update = max(self._next_update + 1 / self.update_rate, now)
+
+    def _parse(self):
+        from ..message import Message
+        header = struct.Struct('<HHBB')
+        while len(self._buffer) >= header.size:
+            message_id, length, dest, source = header.unpack_from(self._buffer)
+            is_long = (dest & 0x80) == 0x80
+            size = header.size + (length if is_long else 0)
+            if len(self._buffer) < size:
+                return
+
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+
+            try:
+                msg = Message.parse(data)
+            except (KeyError, AssertionError):
+                print("Virtual controller ignoring message", hex(message_id))
+                continue
+
+            yield msg
+
+    def _send(self, msg):
+        msg.source = 0x50
+        msg.dest = 0x01
+        try:
+            os.write(self._master, bytes(msg))
+            self.sent += 1
+        except OSError:
+            pass
+
+    @property
+    def _status_bits(self):
+        bits = 0
+        if self._velocity > 0:
+            bits |= 0x00000010
+        elif self._velocity < 0:
+            bits |= 0x00000020
+        if self._homing:
+            bits |= 0x00000200
+        if self._homed:
+            bits |= 0x00000400
+        if self._target is None and not self._direction and not self._velocity:
+            bits |= 0x00002000
+        if self._enabled:
+            bits |= 0x80000000
+        return bits
+
+    def _status_fields(self):
+        return dict(chan_ident = 0x01, position = int(round(self._position)), status_bits = self._status_bits)
+
+    def _send_status(self):
+        from ..message import MGMSG_MOT_GET_DCSTATUSUPDATE
+        velocity = int(self._velocity * self._T)
+        velocity = max(-0x8000, min(0x7fff, velocity))
+        self._send(MGMSG_MOT_GET_DCSTATUSUPDATE(velocity = velocity, **self._status_fields()))
+
+    def _advance(self, now):
+        """Integrate the motion model up to now."""
+        from ..message import MGMSG_MOT_MOVE_COMPLETED, MGMSG_MOT_MOVE_STOPPED, MGMSG_MOT_MOVE_HOMED
+
+        with self._lock:
+            remaining = now - self._time
+            self._time = now
+
+            while remaining > 0 and (self._target is not None or self._direction or self._velocity):
+                h = min(remaining, self._step)
+                remaining -= h
+
+                a = self._acceleration
+                if self._target is not None:
+                    distance = self._target - self._position
+                    #Fastest speed from which we can still stop at the target
+                    desired = min(self._max_velocity, (2 * a * abs(distance)) ** 0.5)
+                    desired = desired if distance >= 0 else -desired
+                else:
+                    desired = self._direction * self._max_velocity
+
+                if desired > self._velocity:
+                    self._velocity = min(desired, self._velocity + a * h)
+                else:
+                    self._velocity = max(desired, self._velocity - a * h)
+
+                self._position += self._velocity * h
+
+                if self._target is not None:
+                    left = self._target - self._position
+                    if abs(left) < 0.5 or (left > 0) != (distance > 0):
+                        self._position = float(self._target)
+                        self._velocity = 0.0
+                        self._target = None
+                        if self._homing:
+                            self._homing = False
+                            self._homed = True
+                            self._send(MGMSG_MOT_MOVE_HOMED(chan_ident = 0x01))
+                        else:
+                            self._send(MGMSG_MOT_MOVE_COMPLETED(**self._status_fields()))
+                elif not self._direction and self._velocity == 0:
+                    self._send(MGMSG_MOT_MOVE_STOPPED(**self._status_fields()))
+
+    def _handle(self, msg):
+        from ..message import (MGMSG_HW_REQ_INFO, MGMSG_HW_GET_INFO, MGMSG_HW_START_UPDATEMSGS,
+                               MGMSG_HW_STOP_UPDATEMSGS, MGMSG_MOD_SET_CHANENABLESTATE,
+                               MGMSG_MOD_REQ_CHANENABLESTATE, MGMSG_MOD_GET_CHANENABLESTATE,
+                               MGMSG_MOT_REQ_DCSTATUSUPDATE, MGMSG_MOT_REQ_STATUSUPDATE,
+                               MGMSG_MOT_GET_STATUSUPDATE, MGMSG_MOT_SET_VELPARAMS,
+                               MGMSG_MOT_REQ_VELPARAMS, MGMSG_MOT_GET_VELPARAMS,
+                               MGMSG_MOT_SET_HOMEPARAMS, MGMSG_MOT_REQ_HOMEPARAMS,
+                               MGMSG_MOT_GET_HOMEPARAMS, MGMSG_MOT_MOVE_ABSOLUTE_long,
+                               MGMSG_MOT_MOVE_RELATIVE_long, MGMSG_MOT_MOVE_HOME,
+                               MGMSG_MOT_MOVE_VELOCITY, MGMSG_MOT_MOVE_STOP)
+
+        #Bring the model up to date before changing it
+        self._advance(time.monotonic())
+
+        with self._lock:
+            if isinstance(msg, MGMSG_HW_REQ_INFO):
+                empty_space = bytearray(12)
+                empty_space[-2] = self.stage_type
+                self._send(MGMSG_HW_GET_INFO(serial_number = self.serial_number, model_number = b'TDC001',
+                                             type = 16, firmware_version = b'\x01\x00\x02\x00',
+                                             notes = b'Virtual APT DC Motor Controller',
+                                             empty_space = bytes(empty_space), hw_version = 1,
+                                             mod_state = 0, nchs = 1))
+
+            elif isinstance(msg, MGMSG_HW_START_UPDATEMSGS):
+                self._updates = True
+                self._next_update = time.monotonic()
+
+            elif isinstance(msg, MGMSG_HW_STOP_UPDATEMSGS):
+                self._updates = False
+
+            elif isinstance(msg, MGMSG_MOD_SET_CHANENABLESTATE):
+                self._enabled = msg['chan_enable_state'] == 0x01
+
+            elif isinstance(msg, MGMSG_MOD_REQ_CHANENABLESTATE):
+                self._send(MGMSG_MOD_GET_CHANENABLESTATE(chan_ident = 0x01,
+                                                         chan_enable_state = 0x01 if self._enabled else 0x02))
+
+            elif isinstance(msg, MGMSG_MOT_REQ_DCSTATUSUPDATE):
+                self._send_status()
+
+            elif isinstance(msg, MGMSG_MOT_REQ_STATUSUPDATE):
+                self._send(MGMSG_MOT_GET_STATUSUPDATE(enc_count = int(round(self._position)),
+                                                      **self._status_fields()))
+
+            elif isinstance(msg, MGMSG_MOT_SET_VELPARAMS):
+                self._min_velocity = msg['min_velocity'] / (self._T * 65536)
+                self._max_velocity = msg['max_velocity'] / (self._T * 65536)
+                self._acceleration = msg['acceleration'] / (self._T ** 2 * 65536)
+
+            elif isinstance(msg, MGMSG_MOT_REQ_VELPARAMS):
+                self._send(MGMSG_MOT_GET_VELPARAMS(chan_ident = 0x01,
+                                                   min_velocity = int(self._min_velocity * self._T * 65536),
+                                                   max_velocity = int(self._max_velocity * self._T * 65536),
+                                                   acceleration = int(self._acceleration * self._T ** 2 * 65536)))
+
+            elif isinstance(msg, MGMSG_MOT_SET_HOMEPARAMS):
+                self._home_params = dict((k, msg[k]) for k in self._home_params)
+
+            elif isinstance(msg, MGMSG_MOT_REQ_HOMEPARAMS):
+                self._send(MGMSG_MOT_GET_HOMEPARAMS(chan_ident = 0x01, **self._home_params))
+
+            elif isinstance(msg, MGMSG_MOT_MOVE_ABSOLUTE_long):
+                self._target = float(msg['absolute_distance'])
+                self._direction = 0
+
+            elif isinstance(msg, MGMSG_MOT_MOVE_RELATIVE_long):
+                self._target = (self._target if self._target is not None else self._position) + msg['relative_distance']
+                self._direction = 0
+
+            elif isinstance(msg, MGMSG_MOT_MOVE_HOME):
+                self._target = 0.0
+                self._direction = 0
+                self._homing = True
+                self._homed = False
+
+            elif isinstance(msg, MGMSG_MOT_MOVE_VELOCITY):
+                self._target = None
+                self._direction = 1 if msg['direction'] == 0x01 else -1
+
+            elif isinstance(msg, MGMSG_MOT_MOVE_STOP):
+                self._target = None
+                self._direction = 0
+                self._homing = False
+                if msg['stop_mode'] == 0x01 or self._velocity == 0:
+                    self._velocity = 0.0
+                    self._send(MGMSG_MOT_MOVE_STOPPED(**self._status_fields()))
+
+
+if __name__ == '__main__':
+    from .discovery import discover_stages
+    from ..message import MGMSG_MOT_REQ_DCSTATUSUPDATE
+
+    #Left running until exit, the port's worker thread reads from it until then
+    controller = VirtualController(update_rate = 100)
+    stage = next(discover_stages(ports = [(controller.port, controller.serial_number)]))
+    history = stage._position_history
+
+    #Round trip of a status request
+    latencies = []
+    for i in range(200):
+        written = history._written
+        start_time = time.monotonic()
+        stage._port.send_message(MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = 0x01))
+        while history._written == written:
+            time.sleep(0.0001)
+        latencies.append(time.monotonic() - start_time)
+    latencies.sort()
+    print("Status round trip: median {0:.3f}ms, 99% {1:.3f}ms".format(latencies[len(latencies) // 2] * 1e3,
+                                                                    latencies[int(len(latencies) * 0.99)] * 1e3))
+
+    #Messages handled while streaming updates and moving
+    start_count, start_time = history._written, time.monotonic()
+    stage.position = 10
+    stage.start_position_stream(500)
+    time.sleep(2)
+    stage.stop_position_stream()
+    count = history._written - start_count
+    print("Status messages: {0:.0f}/s, position {1:.3f}{2}".format(count / (time.monotonic() - start_time),
+                                                                   stage.position, stage.units))
@@ -8,7 +8,15 @@ class IncompleteMessageException(Exception):
     pass
 
 
-class Message:
+class MessageType(type):
+    """Metaclass of messages: gives every message class an empty __slots__,
+    so instances only carry the slots defined by Message."""
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        namespace.setdefault('__slots__', ())
+        return super().__new__(mcs, name, bases, namespace, **kwargs)
+
+
+class Message(metaclass = MessageType):
     """Base class for messages.
     
     Subclasses should override:
@@ -16,14 +24,76 @@ class Message:
     - is_long_cmd (bool)
     - parameters (list of tubles like (name, struct encoding))
     """
+    __slots__ = ('_dest', '_source', '_parameter_values')
     
     #This will be overrided by subclasses
     id = 0x0
     is_long_cmd = False
     parameters = [(None, 'B'), (None, 'B')]
 
-    # class wide caches
+    # class wide caches, built by _compile() when the class is defined
     _struct_description = None
+    _parameter_mapping = {}     # parameter name -> position
+    _decode_fields = ()         # struct field index for each parameter, None for padding
+    _dest_field = 0             # struct field indexes of dest and source
+    _source_field = 0
+    _encode_template = ()       # struct values, with the constant fields filled in
+    _encode_fields = ()         # (struct field index, parameter position) pairs
+
+    # registries of every message class, filled in as they are defined
+    _classes_by_key = {}        # (id, is_long_cmd) -> class
+    _classes_by_id = {}         # id -> [class, ...]
+    _classes_by_name = {}       # name -> class
+    _classes_by_category = {}   # category -> [class, ...]
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        # Some ids are used by both a short and a long message, e.g. MGMSG_MOT_MOVE_ABSOLUTE_short
+        # and MGMSG_MOT_MOVE_ABSOLUTE_long, the long flag in the header tells them apart.
+        key = (cls.id, cls.is_long_cmd)
+        if key in Message._classes_by_key:
+            raise TypeError('{0} has the same id 0x{1:x} as {2}'.format(
+                cls.__name__, cls.id, Message._classes_by_key[key].__name__))
+        if cls.__name__ in Message._classes_by_name:
+            raise TypeError('Message {0} is defined twice'.format(cls.__name__))
+
+        Message._classes_by_key[key] = cls
+        Message._classes_by_id.setdefault(cls.id, []).append(cls)
+        Message._classes_by_name[cls.__name__] = cls
+        Message._classes_by_category.setdefault(cls.category, []).append(cls)
+
+        cls._compile()
+
+    @classmethod
+    def _compile(cls):
+        """Work out, once per class, where each parameter lives in the struct."""
+        if not cls.is_long_cmd:
+            full_struct_desc = [('message_id', 'H'), ] + cls.parameters + [('dest', 'B'), ('source', 'B')]
+        else:
+            full_struct_desc = ([('message_id', 'H'), ('length', 'H'), ('dest', 'B'), ('source', 'B')]
+                                + cls.parameters)
+        names, encodings = zip(*full_struct_desc)
+        message_struct = struct.Struct('<' + ''.join(encodings))
+        cls._struct_description = names, message_struct
+
+        cls._parameter_mapping = {name: position for position, (name, encoding)
+                                  in enumerate(cls.parameters) if name is not None}
+
+        # The parameters follow the 4 header fields of a long message, or the id of a short one
+        first = 4 if cls.is_long_cmd else 1
+        cls._decode_fields = tuple(None if name is None else first + position
+                                   for position, (name, encoding) in enumerate(cls.parameters))
+        cls._dest_field = names.index('dest')
+        cls._source_field = names.index('source')
+
+        template = [0] * len(names)
+        template[0] = cls.id
+        if cls.is_long_cmd:
+            template[1] = message_struct.size - 6
+        cls._encode_template = tuple(template)
+        cls._encode_fields = tuple((field, position) for position, field in enumerate(cls._decode_fields)
+                                   if field is not None)
 
     def __init__(self, *args, source=0x01, dest=None, **kwargs):
         self.dest, self.source = dest, source
@@ -35,8 +105,7 @@ class Message:
             parameter_values[i] = value
 
         # Set parameter by name
-        parameter_mapping = {name: position for position, (name, encoding)
-                             in enumerate(self.parameters)}
+        parameter_mapping = self._parameter_mapping
         for name, value in kwargs.items():
             try:
                 position = parameter_mapping[name]
@@ -53,6 +122,21 @@ class Message:
                 raise ValueError('Parameter {0} "{1}" ({2}) was not set.'.format(position, name, encoding))
         self._parameter_values = parameter_values
 
+    @classmethod
+    def from_buffer(cls, buffer, offset = 0):
+        """Build a message of this class straight from its binary form.
+
+        The fast path for received data: nothing is validated, the caller
+        has checked the id and that enough bytes are there (see parse()).
+        """
+        values = cls._struct_description[1].unpack_from(buffer, offset)
+
+        msg = cls.__new__(cls)
+        msg._dest = values[cls._dest_field] & 0x7f
+        msg._source = values[cls._source_field]
+        msg._parameter_values = [None if field is None else values[field] for field in cls._decode_fields]
+        return msg
+
     @property
     def dest(self):
         return self._dest
@@ -96,20 +180,10 @@ class Message:
 
     @classproperty
     def struct_description(cls):
-        # On the first call the class wide message Struct is not yet built,
-        # after that we may rely on the class wide cache of the Struct.
+        # Built by _compile() when the class was defined
         if cls._struct_description is None:
-            if not cls.is_long_cmd:
-                full_struct_desc = [('message_id', 'H'), ] + cls.parameters + [('dest', 'B'), ('source', 'B')]
-            else:
-                full_struct_desc = ([('message_id', 'H'), ('length', 'H'), ('dest', 'B'), ('source', 'B')]
-                                    + cls.parameters)
-            names, encodings = zip(*full_struct_desc)
-            message_struct = struct.Struct('<' + ''.join(encodings))
-            cls._struct_description = names, message_struct
-        else:
-            names, message_struct = cls._struct_description
-        return names, message_struct
+            cls._compile()
+        return cls._struct_description
 
     @property
     def parameter_items(self):
@@ -127,23 +201,49 @@ class Message:
         if isinstance(k, int):
             return self._parameter_values[k]
         else:
-            # FIXME: This is a bit inefficient since we create dictioneries on the fly.
-            #        However, I doubt this will ever become a bottle neck.
-            return dict(self.parameter_items)[k]
+            return self._parameter_values[self._parameter_mapping[k]]
         
     def __contains__(self, k):
-        return k in self.parameter_names
+        return k in self._parameter_mapping
 
     @classmethod
-    def get_message_class_by_id(cls, message_id):
-        message_classes = list(filter(lambda x: x.id == message_id, Message.__subclasses__()))
+    def get_message_class_by_id(cls, message_id, is_long_cmd = None):
+        """Look up a message class by id.
+
+        is_long_cmd is needed for the ids shared by a short and a long message.
+        """
+        if is_long_cmd is not None:
+            try:
+                return Message._classes_by_key[(message_id, is_long_cmd)]
+            except KeyError:
+                raise KeyError('Unknown message id {0}'.format(message_id))
+
+        message_classes = Message._classes_by_id.get(message_id, [])
         assert len(message_classes) < 2, 'Multiple classes with id {0} defined'.format(message_id)
         if len(message_classes) < 1:
             raise KeyError('Unknown message id {0}'.format(message_id))
         return message_classes[0]
 
+    @classmethod
+    def get_message_class_by_name(cls, name):
+        try:
+            return Message._classes_by_name[name]
+        except KeyError:
+            raise KeyError('Unknown message {0}'.format(name))
+
+    @classmethod
+    def get_message_classes_by_category(cls, category):
+        """Every message class of a category, e.g. 'mot' or 'hw'."""
+        return list(Message._classes_by_category.get(category, []))
+
     @classmethod
     def parse(cls, buffer):
+        """Parse the message at the start of buffer.
+
+        buffer is any bytes-like object, e.g. a memoryview of a receive
+        buffer. It may hold more than one message, only the first is parsed
+        and nothing is copied. Its length is len() of the returned message.
+        """
         base_package = struct.Struct('<HHBB')
         base_package_length = base_package.size
 
@@ -152,36 +252,22 @@ class Message:
             raise IncompleteMessageException()
 
         # Assuming a long message, get its id and length
-        message_id, length, dest, source = base_package.unpack(buffer[:base_package_length])
+        message_id, length, dest, source = base_package.unpack_from(buffer)
         long_message = (dest & 0x80) == 0x80    # Is it really a long message?
+        message_length = base_package_length + (length if long_message else 0)
 
         # In case of a long message, we might not have all bytes yet
-        if len(buffer) < base_package_length + (length if long_message else 0):
+        if len(buffer) < message_length:
             raise IncompleteMessageException()
 
-        msg_cls = Message.get_message_class_by_id(message_id)
-        # TODO: Add checks if long message is really a long message
-        fields, msg_struct = msg_cls.struct_description
-        descr = dict(zip(fields, msg_struct.unpack(buffer)))
-
-        if msg_cls.is_long_cmd:
-            assert descr['dest'] & 0x80, 'Long message expected, but message binary does not mark it as long.'
-            descr['dest'] &= 0x7f
-
-            assert descr['length'] == len(buffer) - 6
-            del descr['length']
+        # The class is looked up with the long flag, so id and flag match
+        msg_cls = Message.get_message_class_by_id(message_id, long_message)
+        assert msg_cls.binary_length == message_length, \
+            'Message {0} is {1} bytes, expected {2}'.format(msg_cls.name, message_length, msg_cls.binary_length)
 
-        assert descr['message_id'] == msg_cls.id
-        del descr['message_id']
-
-        if None in descr:
-            del descr[None]
-
-        return msg_cls(**descr)
+        return msg_cls.from_buffer(buffer)
 
     def __bytes__(self):
-        fields, msg_struct = self.struct_description
-
         if self.dest is None:
             raise RuntimeError('Cannot convert message without destination '
                                'to byte representation')
@@ -190,20 +276,18 @@ class Message:
             raise RuntimeError('Cannot convert message without source to '
                                'to byte representation')
 
-        descr = dict(self.parameter_items)
-        descr['message_id'] = self.id
-        descr['length'] = self.binary_length - 6
-        descr['source'] = self.source
-        descr['dest'] = self.dest | (0x80 if self.is_long_cmd else 0)
-        descr[None] = 0
+        values = list(self._encode_template)
+        values[self._dest_field] = self._dest | (0x80 if self.is_long_cmd else 0)
+        values[self._source_field] = self._source
 
-        values = map(lambda x: descr[x], fields)
+        parameter_values = self._parameter_values
+        for field, position in self._encode_fields:
+            value = parameter_values[position]
+            if type(value) is str:
+                value = value.encode('ascii')
+            values[field] = value
 
-        type_mapping = {
-            str: lambda x: x.encode('ascii')
-        }
-        encoded_values = map(lambda x: type_mapping.get(type(x), type(x))(x), values)
-        return msg_struct.pack(*encoded_values)
+        return self._struct_description[1].pack(*values)
 
     def __repr__(self):
         return "<%s>(dest=0x%x, src=0x%x, %s)" % (self.__class__.__name__,
@@ -1,5 +1,7 @@
 from thorpy.message import *
+from .history import PositionHistory
 import weakref
+import threading
 import time
 import pkgutil
 
@@ -89,13 +91,25 @@ def stage_name_from_get_hw_info(m):
         _print_stage_detection_improve_message(m)
         return None
 
+_stage_config = None
+_stage_config_lock = threading.Lock()
+
+def stage_config():
+    """The parsed MG17APTServer.ini, shared by every stage (it is only read)."""
+    global _stage_config
+    with _stage_config_lock:
+        if _stage_config is None:
+            import configparser
+            config = configparser.ConfigParser()
+            config.read_string(pkgutil.get_data('thorpy.stages','MG17APTServer.ini').decode('ascii'))
+            _stage_config = config
+        return _stage_config
+
 class GenericStage:
-    def __init__(self, port, chan_ident, ini_section):
-        import os, configparser
+    def __init__(self, port, chan_ident, ini_section, history_size = 4096):
         self._port = port
         self._chan_ident = chan_ident
-        self._config = configparser.ConfigParser()
-        self._config.read_string(pkgutil.get_data('thorpy.stages','MG17APTServer.ini').decode('ascii'))
+        self._config = stage_config()
 
         self._name = ini_section
 
@@ -160,7 +174,8 @@ class GenericStage:
             self._conf_js_gearlow_accn = self._config.getfloat(ini_section, 'JS GearLow Accn')
             self._conf_js_dir_sense = self._config.getfloat(ini_section, 'JS Dir Sense')
 
-        self._last_ack_sent = time.time()
+        #Guards the _state_* values, notified whenever a message updates them
+        self._state_changed = threading.Condition()
 
         self._port.send_message(MGMSG_MOD_SET_CHANENABLESTATE(chan_ident = self._chan_ident, chan_enable_state = 0x01))
 
@@ -180,21 +195,30 @@ class GenericStage:
         self._state_home_limit_switch = None
         self._state_home_offset_distance = None
 
+        #Every position we hear about, for position_at()
+        self._position_history = PositionHistory(history_size)
+        self._position_stream = None
+
 
     def __del__(self):
         print("Destructed: {0!r}".format(self))
 
     def _handle_message(self, msg):
-        if self._last_ack_sent < time.time() - 0.5:
-            self._port.send_message(MGMSG_MOT_ACK_DCSTATUSUPDATE())
-            self._last_ack_sent = time.time()
-
+        #Status updates are acknowledged by the port, see Port.keepalive_interval
+        with self._state_changed:
+            handled = self._update_state(msg)
+            if handled:
+                self._state_changed.notify_all()
+        return handled
+
+    def _update_state(self, msg):
         if isinstance(msg, MGMSG_MOT_GET_DCSTATUSUPDATE) or \
            isinstance(msg, MGMSG_MOT_GET_STATUSUPDATE) or \
            isinstance(msg, MGMSG_MOT_MOVE_COMPLETED) or \
            isinstance(msg, MGMSG_MOT_MOVE_STOPPED):
 
             self._state_position = msg['position']
+            self._position_history.append(msg['position'])
             if isinstance(msg, MGMSG_MOT_GET_DCSTATUSUPDATE):
                 self._state_velocity = msg['velocity']
             self._state_status_bits = msg['status_bits']
@@ -305,6 +329,30 @@ class GenericStage:
         self._wait_for_properties(('_state_status_bits', ), timeout = 3, message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident))
         return (self._state_status_bits & 0x80000000) != 0
 
+    def position_at(self, times):
+        """Position at each of times, interpolated from the position history.
+
+        times are time.monotonic() values, a scalar or an array. Start a
+        position stream to get more samples than the controller's own status
+        updates provide. Until the first status update the position is NaN.
+        """
+        return self._position_history.count_at(times) / self._EncCnt
+
+    def start_position_stream(self, rate = 50):
+        """Request a status update rate times a second, feeding the position
+        history in between the controller's own updates.
+        """
+        from thorpy.comm.reactor import Reactor
+        self.stop_position_stream()
+
+        message = MGMSG_MOT_REQ_DCSTATUSUPDATE(chan_ident = self._chan_ident)
+        self._position_stream = Reactor.instance().call_every(1 / rate, lambda: self._port.send_message(message))
+
+    def stop_position_stream(self):
+        if self._position_stream is not None:
+            self._position_stream.cancel()
+            self._position_stream = None
+
     #VELPARAMS
 
     @property
@@ -341,11 +389,12 @@ class GenericStage:
             max_velocity = int(max_velocity *(self._EncCnt * self._T * 65536)),
             acceleration = int(acceleration *(self._EncCnt * (self._T ** 2) * 65536)),
         )
+        #Invalidate current values, before a reply can arrive
+        with self._state_changed:
+            self._state_min_velocity = None
+            self._state_max_velocity = None
+            self._state_acceleration = None
         self._port.send_message(msg)
-        #Invalidate current values
-        self._state_min_velocity = None
-        self._state_max_velocity = None
-        self._state_acceleration = None
 
 
     #HOMEPARAMS
@@ -382,12 +431,13 @@ class GenericStage:
             limit_switch = home_limit_switch,
             offset_distance = int(home_offset_distance*self._EncCnt)
         )
+        #Invalidate current values, before a reply can arrive
+        with self._state_changed:
+            self._state_home_velocity = None
+            self._state_home_direction = None
+            self._state_home_limit_switch = None
+            self._state_home_offset_distance = None
         self._port.send_message(msg)
-        #Invalidate current values
-        self._state_home_velocity = None
-        self._state_home_direction = None
-        self._state_home_limit_switch = None
-        self._state_home_offset_distance = None
 
 
     #Conversion factors
@@ -464,16 +514,30 @@ class GenericStage:
         return True
 
     def _wait_for_properties(self, properties, timeout = None, message = None, message_repeat_timeout = None):
-        start_time = time.time()
-        last_message_time = 0
-        while any(getattr(self, prop) is None for prop in properties):
-            if message is not None:
-                if last_message_time == 0 or (message_repeat_timeout is not None and time.time() - last_message_time > message_repeat_timeout):
-                    self._port.send_message(message)
-                    last_message_time = time.time()
-            time.sleep(0.1)
-            if timeout is not None and time.time() - start_time >= timeout:
-                return False
+        """Wait until none of properties is None, sending message to ask for them.
+
+        Wakes as soon as _handle_message() stores a reply. Raises TimeoutError
+        if they are still missing after timeout seconds.
+        """
+        start_time = time.monotonic()
+        last_message_time = None
+        with self._state_changed:
+            while any(getattr(self, prop) is None for prop in properties):
+                now = time.monotonic()
+                if message is not None:
+                    if last_message_time is None or (message_repeat_timeout is not None and now - last_message_time > message_repeat_timeout):
+                        self._port.send_message(message)
+                        last_message_time = now
+
+                wait_time = None
+                if timeout is not None:
+                    wait_time = start_time + timeout - now
+                    if wait_time <= 0:
+                        raise TimeoutError('{0!r}: no reply for {1} within {2}s'.format(self, ', '.join(properties), timeout))
+                if message is not None and message_repeat_timeout is not None:
+                    repeat_time = last_message_time + message_repeat_timeout - now
+                    wait_time = repeat_time if wait_time is None else min(wait_time, repeat_time)
+                self._state_changed.wait(wait_time)
         return True
 
     def __repr__(self):
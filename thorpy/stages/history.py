@@ -0,0 +1,74 @@
+import threading
+import time
+
+import numpy
+
+#Seconds of history the velocity used for extrapolation is measured over.
+#Status messages often arrive a millisecond apart in one read, the slope
+#between just the last two samples would be mostly noise.
+velocity_span = 0.05
+
+class PositionHistory:
+    """Ring buffer of (host time, encoder count) samples.
+
+    Host times come from time.monotonic() when the status message arrives, so
+    they can be compared with other time.monotonic() stamps, e.g. the arrival
+    time of camera frames.
+    """
+    def __init__(self, size = 4096):
+        self._lock = threading.Lock()
+        self._times = numpy.zeros(size, dtype = numpy.float64)
+        self._counts = numpy.zeros(size, dtype = numpy.int64)
+        self._size = size
+        self._written = 0
+
+    def __len__(self):
+        return min(self._written, self._size)
+
+    def append(self, count, host_time = None):
+        if host_time is None:
+            host_time = time.monotonic()
+
+        with self._lock:
+            i = self._written % self._size
+            self._times[i] = host_time
+            self._counts[i] = count
+            self._written += 1
+
+    def clear(self):
+        with self._lock:
+            self._written = 0
+
+    def samples(self):
+        """Return (times, counts) arrays, oldest sample first."""
+        with self._lock:
+            if self._written <= self._size:
+                return self._times[:self._written].copy(), self._counts[:self._written].copy()
+
+            i = self._written % self._size
+            return numpy.roll(self._times, -i), numpy.roll(self._counts, -i)
+
+    def count_at(self, times):
+        """Interpolate the encoder count at each of times.
+
+        Times past the newest sample are extrapolated with the velocity over
+        the last velocity_span seconds, times before the oldest sample get
+        the oldest count. Without any samples every count is NaN.
+        """
+        sample_times, counts = self.samples()
+        times = numpy.asarray(times, dtype = numpy.float64)
+
+        if len(sample_times) == 0:
+            result = numpy.full(times.shape, numpy.nan)
+            return result[()] if result.ndim == 0 else result
+
+        result = numpy.interp(times, sample_times, counts)
+
+        #The newest sample against one at least velocity_span older, or the oldest there is
+        start = max(0, numpy.searchsorted(sample_times, sample_times[-1] - velocity_span, side = 'right') - 1)
+        if sample_times[-1] > sample_times[start]:
+            velocity = (counts[-1] - counts[start]) / (sample_times[-1] - sample_times[start])
+            late = times > sample_times[-1]
+            result = numpy.where(late, counts[-1] + (times - sample_times[-1]) * velocity, result)
+
+        return result[()] if result.ndim == 0 else result
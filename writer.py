@@ -0,0 +1,151 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+# number of threads saving frames in the background
+default_workers = 4
+
+# frames waiting to be saved before the camera thread is held back
+default_queue_size = 16
+
+
+class Files:
+    """Save each frame to its own file, named by time and position.
+
+    codec -- the codec.Codec to store frames with
+    order -- the channel order of the frames, see camera.Frame.order
+    """
+
+    def __init__(self, location, codec, order='RGB'):
+        self.location = location
+        self.codec = codec
+        self.order = order
+
+    def save(self, roi, timestamp, position):
+        image_name = "%s_%s%s" % (timestamp, position, self.codec.extension)
+        image_path = os.path.join(self.location, image_name)
+
+        self.codec.save(image_path, roi, self.order)
+
+        # frames don't share a file, so there is no offset
+        return image_name, -1
+
+    def close(self):
+        pass
+
+
+class Writer:
+    """Save captured frames on a pool of background threads.
+
+    The camera callback only hands over a view of the region of interest, the
+    worker threads pass it to the output's save() method, see Files and
+    container.Container, then add a row to the manifest.Manifest, if any.
+    The queue is bounded: once it is full put() blocks the caller and the
+    time spent waiting is recorded as back-pressure.
+    """
+
+    def __init__(self, output, workers=default_workers,
+                 queue_size=default_queue_size, manifest=None):
+        self.output = output
+        self.manifest = manifest
+        self.queue = queue.Queue(queue_size)
+
+        # statistics, updated by put() and the workers
+        self.lock = threading.Lock()
+        self.max_depth = 0
+        self.written = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.run,
+                                      name='writer-%d' % i,
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+
+            try:
+                if item is None:
+                    return
+
+                roi, timestamp, position, frame, index, host_time = item
+
+                try:
+                    file, offset = self.output.save(roi, timestamp,
+                                                    position)
+                finally:
+                    if frame is not None:
+                        frame.release()
+
+                if self.manifest:
+                    self.manifest.append(index, timestamp, host_time,
+                                         position, file, offset)
+
+                with self.lock:
+                    self.written += 1
+            except Exception:
+                logging.exception('writer: unable to save frame')
+            finally:
+                self.queue.task_done()
+
+    def put(self, roi, timestamp, position, frame=None):
+        """Queue a frame for saving.
+
+        roi -- the pixels to save, this is not copied
+        timestamp -- seconds since the start of the capture
+        position -- degrees since the start of the capture
+        frame -- the camera.Frame roi points into, held until saved
+        """
+        if frame is not None:
+            frame.acquire()
+            item = (roi, timestamp, position, frame,
+                    frame.index, frame.host_time)
+        else:
+            item = (roi, timestamp, position, None, -1, 0.0)
+
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            start_time = time.time()
+            self.queue.put(item)
+
+            with self.lock:
+                self.stalls += 1
+                self.stall_time += time.time() - start_time
+
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    @property
+    def depth(self):
+        """Number of frames waiting to be saved."""
+        return self.queue.qsize()
+
+    def close(self):
+        """Save any queued frames, stop the worker threads and close the
+        output and manifest.
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+        self.output.close()
+
+        if self.manifest:
+            self.manifest.close()
+
+        logging.debug('writer: %d frames, max depth %d, '
+                      '%d stalls (%.3fs)',
+                      self.written, self.max_depth,
+                      self.stalls, self.stall_time)